@@ -0,0 +1,183 @@
+"""
+Audit a bundle for embedded absolute paths which will not exist on a
+user's machine, such as the real path of the build prefix or the
+builder's repository.
+
+Every file is memory mapped.  In Mach-O files the __cstring and __const
+sections of each architecture are scanned; text files, such as .la and
+.pc files and scripts, are scanned in full.  All of the forbidden
+prefixes are matched at once and the files are scanned by a pool of
+worker processes.  The hits are reported grouped by package directory
+under local/ and the venv, and the exit status is 1 if there are any.
+
+Usage: python3 audit_paths.py [--forbid PREFIX ...] [--jobs N]
+           [--json report.json] <bundle>
+"""
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from macho import MachO, MachOError
+from classify import FileTable, MACHO, SCRIPT, CONFIG, OTHER
+
+# The real path of the build prefix; the /var/tmp symlink itself is fine.
+FORBIDDEN = ('/private/var/tmp/sage-',)
+SECTIONS = ('__cstring', '__const')
+# Bytes read to decide whether a file is text.
+TEXT_PROBE = 8192
+# Longest string shown in the report for one hit.
+MAX_CONTEXT = 200
+
+def compile_prefixes(prefixes):
+    prefixes = sorted(set(os.fsencode(p) for p in prefixes), key=len,
+                      reverse=True)
+    return re.compile(b'|'.join(re.escape(p) for p in prefixes))
+
+def context(data, start, separators):
+    """
+    Return the string containing position start, delimited by any of the
+    separator bytes.
+    """
+    lowest = max(0, start - MAX_CONTEXT)
+    begin = max(max(data.rfind(sep, lowest, start) + 1, lowest)
+                for sep in separators)
+    ends = [data.find(sep, start, start + MAX_CONTEXT) for sep in separators]
+    ends = [end for end in ends if end >= 0]
+    end = min(ends) if ends else min(len(data), start + MAX_CONTEXT)
+    return data[begin:end].decode('utf-8', 'replace')
+
+def scan_ranges(pattern, data, ranges, separators):
+    found = []
+    for start, end in ranges:
+        for match in pattern.finditer(data, start, end):
+            found.append(context(data, match.start(), separators))
+    return list(dict.fromkeys(found))
+
+def macho_ranges(path):
+    """
+    Return (where, start, end) for each section to be scanned.
+    """
+    ranges = []
+    for header in MachO(path).headers:
+        for segname, sectname, offset, size, flags in header.sections():
+            if sectname in SECTIONS and offset and size:
+                start = header.offset + offset
+                ranges.append(('%s,%s (%s)'%(segname, sectname, header.arch),
+                               start, start + size))
+    return ranges
+
+def audit_file(pattern, root, path, kind):
+    """
+    Return a list of (path, where, string) for the forbidden paths found
+    in one file.
+    """
+    relpath = os.path.relpath(path, root)
+    try:
+        if not os.path.getsize(path):
+            return []
+        with open(path, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                if pattern.search(data) is None:
+                    return []
+                if kind == MACHO:
+                    hits = []
+                    for where, start, end in macho_ranges(path):
+                        hits += [(relpath, where, string) for string in
+                                 scan_ranges(pattern, data, [(start, end)],
+                                             (b'\0',))]
+                    return hits
+                if kind == OTHER and b'\0' in data[:TEXT_PROBE]:
+                    return []
+                return [(relpath, 'text', string) for string in
+                        scan_ranges(pattern, data, [(0, len(data))],
+                                    (b'\n', b'\0'))]
+    except (OSError, ValueError, MachOError) as e:
+        print('Skipping %s: %s'%(path, e), file=sys.stderr)
+        return []
+
+def package_dir(relpath):
+    """
+    The package directory which contains a file: the directory below
+    site-packages, or else the first two directories below the venv or
+    local.
+    """
+    parts = relpath.split(os.path.sep)[:-1]
+    if 'site-packages' in parts:
+        return os.path.join(*parts[:parts.index('site-packages') + 2])
+    for n, part in enumerate(parts):
+        if part.startswith('venv-'):
+            return os.path.join(*parts[:n + 2])
+    if parts[:1] == ['local']:
+        return os.path.join(*parts[:3])
+    return os.path.join(*parts) if parts else '.'
+
+def audit_bundle(root, prefixes=FORBIDDEN, jobs=1, table=None):
+    """
+    Scan every file below root.  Return the number of files and bytes
+    scanned and the sorted list of hits.
+    """
+    root = os.path.abspath(root)
+    if table is None:
+        table = FileTable().scan(root)
+    pattern = compile_prefixes(prefixes)
+    paths = table.paths(MACHO, SCRIPT, CONFIG, OTHER, under=[root])
+    size = sum(table.entries[path].size for path in paths)
+    args = ([pattern]*len(paths), [root]*len(paths), paths,
+            [table.entries[path].kind for path in paths])
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(audit_file, *args, chunksize=64))
+    else:
+        results = list(map(audit_file, *args))
+    return len(paths), size, sorted(hit for hits in results for hit in hits)
+
+def report(count, size, hits, elapsed):
+    groups = {}
+    for hit in hits:
+        groups.setdefault(package_dir(hit[0]), []).append(hit)
+    lines = []
+    for group in sorted(groups):
+        lines.append('%s (%d):'%(group, len(groups[group])))
+        lines += ['    %s [%s]: %s'%hit for hit in groups[group]]
+    lines.append('Scanned %d files (%.1f MB) in %.1fs, found %d forbidden '
+                 'paths in %d packages'%(count, size/1e6, elapsed,
+                                         len(hits), len(groups)))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find forbidden absolute paths embedded in the files '
+        'of a bundle.')
+    parser.add_argument('bundle')
+    parser.add_argument('--forbid', action='append', metavar='PREFIX',
+                        help='a forbidden prefix; may be given more than '
+                        'once (default: %s)'%', '.join(FORBIDDEN))
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--json', metavar='REPORT',
+                        help='also write the hits to REPORT as JSON')
+    args = parser.parse_args()
+    if not os.path.isdir(args.bundle):
+        print('%s is not a directory'%args.bundle)
+        sys.exit(1)
+    start = time.perf_counter()
+    count, size, hits = audit_bundle(args.bundle, args.forbid or FORBIDDEN,
+                                     args.jobs)
+    print(report(count, size, hits, time.perf_counter() - start))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump({'scanned': count,
+                       'hits': [dict(package=package_dir(path), path=path,
+                                     where=where, string=string)
+                                for path, where, string in hits]},
+                      outfile, indent=1)
+    sys.exit(1 if hits else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Compare the in-process Mach-O reader with the macher subprocess used by
+fix_paths, on a synthetic corpus of thin and fat Mach-O files.
+
+Usage: python3 bench_macho.py [-n count] [--macher command]
+
+If macher is not installed (e.g. on Linux) this script is used as a
+stand-in: "bench_macho.py info <file>" prints the same lines that
+fix_paths parses from "macher info", so the subprocess path pays the
+real cost of one fork per file.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+from macho import MachO
+from synth_macho import make_tree
+from classify import FileTable, MACHO
+import fix_paths
+from tools import Tools
+
+def make_corpus(root, count):
+    """
+    Create a synthetic tree with count libraries, and return the paths of
+    all of its Mach-O files.
+    """
+    make_tree(root, libs=count)
+    return FileTable().scan(root).paths(MACHO)
+
+def print_info(path):
+    """Print the part of macher's info output which fix_paths uses."""
+    macho = MachO(path)
+    for header in macho.headers:
+        print('Filetype: %s'%header.filetype)
+        for dylib in header.dylibs:
+            print('    LC_LOAD_DYLIB: %s'%dylib)
+        for rpath in header.rpaths:
+            print('    LC_RPATH: %s'%rpath)
+
+def timed(label, paths, reader):
+    start = time.perf_counter()
+    results = [reader(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    print('%-12s %6d files in %7.3fs  (%9.1f files/s)'%(
+        label, len(paths), elapsed, len(paths)/elapsed))
+    return results, elapsed
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['info']:
+        print_info(args[1])
+        return
+    count = 300
+    macher = None
+    while args:
+        option = args.pop(0)
+        if option == '-n':
+            count = int(args.pop(0))
+        elif option == '--macher':
+            macher = args.pop(0).split()
+        else:
+            print(__doc__)
+            sys.exit(1)
+    if macher is None:
+        if shutil.which('macher'):
+            macher = ['macher']
+        else:
+            macher = [sys.executable, os.path.abspath(__file__)]
+    tools = Tools({'macher': macher})
+    root = tempfile.mkdtemp()
+    try:
+        paths = make_corpus(os.path.join(root, 'sage'), count)
+        def in_process(path):
+            macho = MachO(path)
+            return macho.filetype, macho.dylibs, macho.rpaths
+        def subprocess_path(path):
+            filetype, dylibs, rpaths = fix_paths.macher_info(path, tools)
+            return (filetype, fix_paths.unique(dylibs),
+                    fix_paths.unique(rpaths))
+        fast, fast_time = timed('in-process', paths, in_process)
+        slow, slow_time = timed('subprocess', paths, subprocess_path)
+        if fast != slow:
+            print('The two readers disagree!')
+            sys.exit(1)
+        print('Speedup: %.1fx'%(slow_time/fast_time))
+        print(tools.summary())
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark the relocation stages of fix_paths on a synthetic Sage tree.
+
+The stages are timed separately: classifying the tree, parsing the
+Mach-O files, computing rpaths (both with the bundle-wide DylibGraph and
+with MachFile.fixed_rpaths), fixing the files and verifying the result
+with check_rpaths.  Throughput is reported in files/s and bytes/s.
+Stripping uses a stand-in tool, since Apple's strip is not available on
+Linux.
+
+The results can be saved with --save and compared against a saved
+baseline with --compare; the exit status is 1 if any stage is slower
+than the baseline by more than the tolerance.
+
+Usage: python3 bench_relocation.py [--libs N] [--jobs N] [--save FILE]
+           [--compare FILE] [--tolerance FRACTION]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import fix_paths
+from fix_paths import MachFile, fix_files
+from synth_macho import make_tree, PREFIX
+from classify import FileTable, MACHO
+from dylib_graph import DylibGraph
+from strip_stage import StripStage
+from check_rpaths import check_bundle
+
+class Benchmark:
+    def __init__(self, paths):
+        self.files = len(paths)
+        self.bytes = sum(os.path.getsize(path) for path in paths)
+        self.results = {}
+
+    def time(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        self.results[stage] = {
+            'seconds': elapsed,
+            'files_per_s': self.files/elapsed,
+            'bytes_per_s': self.bytes/elapsed}
+        print('%-10s %8.3fs %12.1f files/s %10.1f MB/s'%(
+            stage, elapsed, self.files/elapsed, self.bytes/elapsed/1e6))
+        return result
+
+def compare(results, baseline, tolerance):
+    """
+    Return the list of stages which are slower than the baseline.
+    """
+    slower = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        ratio = result['files_per_s']/baseline[stage]['files_per_s']
+        if ratio < 1 - tolerance:
+            slower.append('%s: %.0f%% of baseline throughput'%(
+                stage, 100*ratio))
+    return slower
+
+def run(root, libs, jobs):
+    make_tree(root, libs=libs)
+    fix_paths.LOCAL_LIB = os.path.join(PREFIX, 'local', 'lib')
+    local = os.path.join(root, 'local')
+    table = FileTable().scan(local)
+    paths = table.paths(MACHO)
+    bench = Benchmark(paths)
+    bench.time('classify', lambda: FileTable().scan(local))
+    bench.time('parse', lambda: [MachFile(path) for path in paths])
+    def build_graph():
+        graph = DylibGraph(root, fix_paths.LOCAL_LIB)
+        for path in paths:
+            graph.add(path)
+        return graph, [graph.rpaths_for(path) for path in paths]
+    graph, _ = bench.time('graph', build_graph)
+    bench.time('rpaths', lambda: [MachFile(path).fixed_rpaths()
+                                  for path in paths])
+    strip = StripStage(['true'], jobs)
+    bench.time('fix', fix_files, None, [local], jobs, None, graph, False,
+               strip, table)
+    bench.time('check', check_bundle, root, jobs)
+    return bench.results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark fix_paths on a synthetic Sage tree.')
+    parser.add_argument('--libs', type=int, default=1000)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional loss of throughput')
+    args = parser.parse_args()
+    temp_dir = tempfile.mkdtemp()
+    try:
+        results = run(os.path.join(temp_dir, 'sage'), args.libs, args.jobs)
+    finally:
+        shutil.rmtree(temp_dir)
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+    if args.compare:
+        with open(args.compare) as infile:
+            slower = compare(results, json.load(infile), args.tolerance)
+        if slower:
+            print('Performance regressions:')
+            print('\n'.join('    ' + line for line in slower))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -106,4 +106,8 @@ if [ -e repo/documentation ]; then
     mv repo/documentation repo/documentation.old
 fi
 cp -R repo/sage/local/share/doc/sage/html/en repo/documentation
-../bin/compress_site.py repo/documentation
+if [ -e repo/documentation.old ]; then
+    ../bin/compress_site.py --previous repo/documentation.old repo/documentation
+else
+    ../bin/compress_site.py repo/documentation
+fi
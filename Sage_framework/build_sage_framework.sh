@@ -128,16 +128,31 @@ NOTEBOOK_KERNELS=${NOTEBOOK_VENV}/share/jupyter/kernels
 mkdir -p ${NOTEBOOK_KERNELS}/sagemath
 sed "s/__VERSION__/${VERSION}/g" "${FILES}"/kernel.json > ${NOTEBOOK_KERNELS}/sagemath/kernel.json
 
+# Replace the build prefix in text files and in Mach-O string data.  This
+# must come before fix_paths, which signs the Mach-O files.
+echo "Relocating files ..."
+python3 relocate_prefixes.py --jobs `sysctl -n hw.ncpu` \
+    --prefix ${REPO}=/var/tmp/sage-${VERSION}-current \
+    --prefix /private/var/tmp/sage-${VERSION}-current=/var/tmp/sage-${VERSION}-current \
+    ${VERSION_DIR}
+
+# Remove xattrs (must be done before signing, and fix_paths signs!)
+xattr -rc ${BUILD}/Sage.framework
+
 # Fix up rpaths and shebangs 
 echo "Patching files ..."
 source ../IDs.sh
-mv files_to_sign files_to_sign.bak
-python3 fix_paths.py repo ${VERSION_DIR}/local/bin >> files_to_sign
-python3 fix_paths.py repo ${VERSION_DIR}/local/lib >> files_to_sign
-python3 fix_paths.py repo ${VERSION_DIR}/local/libexec >> files_to_sign
-python3 fix_paths.py repo ${VERSION_DIR}/${VENV_DIR}/bin >> files_to_sign
-python3 fix_paths.py repo ${VERSION_DIR}/${VENV_DIR}/lib >> files_to_sign
-find ${NOTEBOOK_VENV} -name '*.so' >> files_to_sign
+# Each file is signed as soon as it has been relocated and stripped, and
+# recorded in the manifest which sign_sage.py reads.
+rm -f files_to_sign.jsonl
+python3 fix_paths.py --jobs `sysctl -n hw.ncpu` --sign \
+    --manifest files_to_sign.jsonl repo \
+    ${VERSION_DIR}/local/bin \
+    ${VERSION_DIR}/local/lib \
+    ${VERSION_DIR}/local/libexec \
+    ${VERSION_DIR}/${VENV_DIR}/bin \
+    ${VERSION_DIR}/${VENV_DIR}/lib > /dev/null
+find ${NOTEBOOK_VENV} -name '*.so' | python3 manifest.py files_to_sign.jsonl
 python3 fix_scripts.py ${NOTEBOOK_VENV}/bin
 
 # Replace Sage's Pillow with the binary package from pypi, so libjpeg will work.
@@ -146,8 +161,14 @@ PIP_TARGET=${VERSION_DIR}/${VENV_PYLIB}/site-packages
 PIP_ARGS="install --upgrade --no-user --force --only-binary :all:"
 echo Re-installing Pillow
 ${VERSION_DIR}/venv/bin/python3 -m pip ${PIP_ARGS} --target ${PIP_TARGET} Pillow
-find ${PIP_TARGET}/PIL/ -name '*.dylib' >> files_to_sign
-find ${PIP_TARGET}/PIL/ -name '*.so' >> files_to_sign
+find ${PIP_TARGET}/PIL/ -name '*.dylib' -o -name '*.so' | \
+    python3 manifest.py files_to_sign.jsonl
+
+# Verify that every load path and rpath resolves inside the bundle.
+python3 check_rpaths.py --json rpath_report.json ${VERSION_DIR}
+# Look for build paths left in C strings and text files.
+python3 audit_paths.py --forbid /private/var/tmp/sage- --forbid ${REPO} \
+    --json path_audit.json ${VERSION_DIR}
 
 # Fix the absolute symlinks for the GAP packages
 pushd ${VERSION_DIR}/local/share/gap/pkg > /dev/null
@@ -159,7 +180,8 @@ for pkg in `ls` ; do
 done
 popd > /dev/null
 
-# Remove xattrs (must be done before signing!)
+# Remove xattrs from the files added since fix_paths, such as Pillow,
+# before they are signed.
 xattr -rc ${BUILD}/Sage.framework
 
 # Remove byte code
@@ -0,0 +1,153 @@
+"""
+Verify the load paths and rpaths of every Mach-O file in a bundle.
+
+Each @rpath, @loader_path and @executable_path dependency is resolved
+against the bundle layout the way dyld would resolve it.  A problem is
+reported for any non-system absolute load path or rpath, any dependency
+which cannot be found, and any dependency or rpath which resolves to a
+location outside of the bundle.  The exit status is 1 if there are any
+problems.
+
+Usage: python3 check_rpaths.py [--jobs N] [--json report.json] <bundle>
+"""
+
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from macho import MachO, MachOError, DYLIB_COMMANDS, LC_ID_DYLIB, LC_RPATH
+from classify import FileTable, MACHO
+from dylib_graph import is_system
+
+ABSOLUTE = 'absolute'
+UNRESOLVED = 'unresolved'
+OUTSIDE = 'outside'
+UNREADABLE = 'unreadable'
+
+LOAD_COMMANDS = tuple(cmd for cmd in DYLIB_COMMANDS if cmd != LC_ID_DYLIB)
+
+def inside(root, path):
+    return path == root or path.startswith(os.path.join(root, ''))
+
+def expand(path, filetype, name):
+    """
+    Expand a leading @loader_path or @executable_path.  The executable is
+    only known when the file is itself the executable; otherwise None is
+    returned for @executable_path.
+    """
+    directory = os.path.dirname(path)
+    if name.startswith('@loader_path'):
+        return os.path.normpath(directory + name[len('@loader_path'):])
+    if name.startswith('@executable_path'):
+        if filetype != 'MH_EXECUTE':
+            return None
+        return os.path.normpath(directory + name[len('@executable_path'):])
+    return name
+
+def check_file(root, path):
+    """
+    Return a list of (kind, path, detail) for the problems found in the
+    Mach-O file with the given path.
+    """
+    problems = []
+    def problem(kind, detail):
+        problems.append((kind, os.path.relpath(path, root), detail))
+    try:
+        macho = MachO(path)
+    except (OSError, MachOError) as e:
+        problem(UNREADABLE, str(e))
+        return problems
+    filetype = macho.filetype
+    for header in macho.headers:
+        rpaths = []
+        for rpath in header.strings(LC_RPATH):
+            if os.path.isabs(rpath) and not is_system(rpath):
+                problem(ABSOLUTE, 'LC_RPATH %s'%rpath)
+                continue
+            expanded = expand(path, filetype, rpath)
+            if expanded is None:
+                continue
+            if not inside(root, os.path.realpath(expanded)):
+                problem(OUTSIDE, 'LC_RPATH %s'%rpath)
+                continue
+            rpaths.append(expanded)
+        for dylib in header.strings(*LOAD_COMMANDS):
+            if is_system(dylib):
+                continue
+            if os.path.isabs(dylib):
+                problem(ABSOLUTE, dylib)
+                continue
+            if dylib.startswith('@rpath/'):
+                tail = dylib[len('@rpath/'):]
+                candidates = [os.path.join(rpath, tail) for rpath in rpaths]
+            else:
+                expanded = expand(path, filetype, dylib)
+                if expanded is None:
+                    # @executable_path in a library; the executable is
+                    # not known.
+                    continue
+                candidates = [expanded]
+            found = [c for c in candidates if os.path.exists(c)]
+            if not found:
+                problem(UNRESOLVED, '%s (%s)'%(dylib, header.arch))
+            elif not inside(root, os.path.realpath(found[0])):
+                problem(OUTSIDE, '%s -> %s'%(dylib, found[0]))
+    return list(dict.fromkeys(problems))
+
+def check_bundle(root, jobs=1, table=None):
+    """
+    Check every Mach-O file below root.  Return the number of files
+    checked and the sorted list of problems.  Dependencies are compared
+    with root after resolving symlinks, so root is resolved too, and a
+    table, if given, must be a scan of the resolved root.
+    """
+    root = os.path.realpath(root)
+    if table is None:
+        table = FileTable().scan(root)
+    paths = table.paths(MACHO, under=[root])
+    roots = [root]*len(paths)
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = pool.map(check_file, roots, paths, chunksize=64)
+            problems = [p for result in results for p in result]
+    else:
+        problems = [p for result in map(check_file, roots, paths)
+                    for p in result]
+    return len(paths), sorted(problems)
+
+def report(count, problems):
+    lines = []
+    for kind in (ABSOLUTE, UNRESOLVED, OUTSIDE, UNREADABLE):
+        found = [p for p in problems if p[0] == kind]
+        if found:
+            lines.append('%s (%d):'%(kind, len(found)))
+            lines += ['    %s: %s'%(path, detail) for _, path, detail in found]
+    lines.append('Checked %d Mach-O files, found %d problems'%(
+        count, len(problems)))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the load paths and rpaths in a bundle.')
+    parser.add_argument('bundle')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--json', metavar='REPORT',
+                        help='also write the problems to REPORT as JSON')
+    args = parser.parse_args()
+    if not os.path.isdir(args.bundle):
+        print('%s is not a directory'%args.bundle)
+        sys.exit(1)
+    count, problems = check_bundle(args.bundle, args.jobs)
+    print(report(count, problems))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump({'checked': count,
+                       'problems': [dict(kind=kind, path=path, detail=detail)
+                                    for kind, path, detail in problems]},
+                      outfile, indent=1)
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1 +0,0 @@
-find SageMath/local/lib -exec bash -c "macher info '{}' | grep RPATH | grep var/tmp" \;
@@ -0,0 +1,161 @@
+"""
+Classify every file in a directory tree with a single scandir walk and
+a single read of the start of each file.
+
+Each path is sorted into one of the kinds below.  Mach-O files also
+record their architectures.  The resulting FileTable is shared by
+fix_paths, fix_scripts and relativize_links, and can be saved so that a
+later run only needs to re-read files whose size or mtime changed.
+"""
+
+import os
+import json
+import struct
+from collections import namedtuple
+from macho import (CPU_TYPES, MAX_FAT_ARCHS, MH_MAGIC, MH_MAGIC_64,
+                   MH_CIGAM, MH_CIGAM_64, FAT_MAGIC, FAT_MAGIC_64, FAT_CIGAM,
+                   FAT_CIGAM_64)
+
+MACHO = 'macho'
+SCRIPT = 'script'
+CONFIG = 'config'
+SYMLINK = 'symlink'
+OTHER = 'other'
+
+# The magic numbers of Mach-O files, as read big-endian from the start of
+# the file.  Fat headers are always big-endian.
+FAT = (FAT_MAGIC, FAT_MAGIC_64)
+THIN_BIG = (MH_MAGIC, MH_MAGIC_64)
+THIN_LITTLE = (MH_CIGAM, MH_CIGAM_64)
+MAGICS = FAT + THIN_BIG + THIN_LITTLE + (FAT_CIGAM, FAT_CIGAM_64)
+
+# Enough to hold the architecture table of any plausible fat file.
+HEADER_SIZE = 8 + 32*MAX_FAT_ARCHS
+
+Entry = namedtuple('Entry', ['kind', 'archs', 'size', 'mtime'])
+
+def is_config(dirpath, filename):
+    """
+    Config files which may contain the build prefix.
+    """
+    return (filename.endswith('.pc') or
+            filename == 'sage_conf.py' or
+            (filename.startswith('_sysconfigdata') and
+             filename.endswith('.py')) or
+            (filename == 'Makefile' and
+             os.path.basename(dirpath).startswith('config-')))
+
+def classify_header(data):
+    """
+    Return (kind, archs) for a file which starts with the given bytes.
+    """
+    if data[:2] == b'#!':
+        return SCRIPT, ()
+    if len(data) < 4:
+        return OTHER, ()
+    magic = struct.unpack('>I', data[:4])[0]
+    if magic not in MAGICS:
+        return OTHER, ()
+    if magic in FAT:
+        nfat_arch = struct.unpack('>I', data[4:8])[0]
+        # A Java class file also starts with 0xcafebabe.
+        if nfat_arch > MAX_FAT_ARCHS:
+            return OTHER, ()
+        arch_size = 32 if magic == FAT_MAGIC_64 else 20
+        archs = []
+        for n in range(nfat_arch):
+            start = 8 + n*arch_size
+            if start + 4 > len(data):
+                break
+            cputype = struct.unpack('>I', data[start:start + 4])[0]
+            archs.append(CPU_TYPES.get(cputype, 'cpu%d'%cputype))
+        return MACHO, tuple(archs)
+    if magic in THIN_LITTLE:
+        cputype = struct.unpack('<I', data[4:8])[0]
+    elif magic in THIN_BIG:
+        cputype = struct.unpack('>I', data[4:8])[0]
+    else:
+        return MACHO, ()
+    return MACHO, (CPU_TYPES.get(cputype, 'cpu%d'%cputype),)
+
+def read_header(path):
+    try:
+        with open(path, 'rb') as inputfile:
+            return inputfile.read(HEADER_SIZE)
+    except OSError:
+        return b''
+
+class FileTable:
+    """
+    The classification of every file and symlink below a set of roots.
+    If a cache path is given, saved entries whose size and mtime still
+    match are used without reading the file.
+    """
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.reads = 0
+        self._saved = {}
+        if cache_path:
+            try:
+                with open(cache_path) as infile:
+                    self._saved = json.load(infile)
+            except (OSError, ValueError):
+                pass
+
+    def scan(self, *roots):
+        for root in roots:
+            self._walk(root)
+        return self
+
+    def _walk(self, root):
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                with os.scandir(dirpath) as it:
+                    dir_entries = list(it)
+            except OSError:
+                continue
+            for dir_entry in dir_entries:
+                path = dir_entry.path
+                if dir_entry.is_symlink():
+                    self.entries[path] = Entry(SYMLINK, (), 0, 0)
+                elif dir_entry.is_dir():
+                    stack.append(path)
+                else:
+                    st = dir_entry.stat(follow_symlinks=False)
+                    self.entries[path] = self._classify(
+                        dirpath, dir_entry.name, path, st)
+
+    def _classify(self, dirpath, filename, path, st):
+        saved = self._saved.get(path)
+        if saved and saved[2] == st.st_size and saved[3] == st.st_mtime_ns:
+            return Entry(saved[0], tuple(saved[1]), saved[2], saved[3])
+        if is_config(dirpath, filename):
+            kind, archs = CONFIG, ()
+        else:
+            self.reads += 1
+            kind, archs = classify_header(read_header(path))
+        return Entry(kind, archs, st.st_size, st.st_mtime_ns)
+
+    def paths(self, *kinds, under=None):
+        """
+        Return the sorted list of paths of the given kinds, optionally
+        restricted to paths below the given directories.
+        """
+        prefixes = None
+        if under is not None:
+            prefixes = tuple(os.path.join(d, '') for d in under)
+        return sorted(path for path, entry in self.entries.items()
+                      if entry.kind in kinds and
+                      (prefixes is None or path.startswith(prefixes)))
+
+    def save(self, cache_path=None):
+        cache_path = cache_path or self.cache_path
+        temp = cache_path + '.tmp'
+        with open(temp, 'w') as outfile:
+            json.dump(dict((path, list(entry))
+                           for path, entry in self.entries.items()
+                           if entry.kind != SYMLINK), outfile)
+        os.replace(temp, cache_path)
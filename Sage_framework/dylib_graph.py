@@ -0,0 +1,162 @@
+"""
+A bundle-wide index of Mach-O files, used by fix_paths to compute the
+rpaths of each file from the places where its dependencies actually live
+in the bundle.
+
+Files are indexed by install name and by basename.  A dependency is
+resolved by install name, then through the existing rpaths, then by
+basename.  Dependencies which cannot be found in the bundle are recorded
+in DylibGraph.unresolved instead of producing a useless rpath.
+"""
+
+import os
+from macho import MachO, MachOError
+
+def unique(some_list):
+    return list(dict((x, None) for x in some_list).keys())
+
+def is_system(dylib):
+    return (dylib.startswith('/usr') or dylib.startswith('/lib') or
+            dylib.startswith('/System'))
+
+def bundle_root(path):
+    """
+    Return the directory containing the local directory of the bundle
+    which contains the given path.
+    """
+    nodes = os.path.abspath(path).split(os.path.sep)
+    return os.path.sep.join(nodes[:nodes.index('local')]) or os.path.sep
+
+def bundle_path(root, path):
+    """
+    Return the path in the bundle corresponding to a path in the build
+    tree, e.g. /var/tmp/sage-X.X-current/local/lib/libgmp.dylib.
+    """
+    nodes = path.split(os.path.sep)
+    try:
+        index = nodes.index('local')
+    except ValueError:
+        return None
+    return os.path.join(root, *nodes[index:])
+
+class DylibGraph:
+    def __init__(self, root, local_lib):
+        self.root = root
+        # The bundle directory where libraries from /opt are installed.
+        self.local_lib = bundle_path(root, local_lib)
+        self.files = {}
+        self.by_name = {}
+        self.by_basename = {}
+        self.unresolved = {}
+        self._relpaths = {}
+
+    def add(self, path):
+        """
+        Index the Mach-O file with the given path.  Files which cannot be
+        parsed are ignored.
+        """
+        try:
+            macho = MachO(path)
+        except MachOError:
+            return
+        dylibs = [dylib for dylib in macho.dylibs if not is_system(dylib)]
+        self.files[path] = (macho.filetype, dylibs, macho.rpaths)
+        if macho.install_name:
+            self.by_name[macho.install_name] = path
+        self.by_basename.setdefault(os.path.basename(path), []).append(path)
+
+    def relative_path(self, from_dir, to_dir):
+        """
+        Return the relative path between two directories, memoized since
+        most files in a directory depend on the same few directories.
+        """
+        key = (from_dir, to_dir)
+        try:
+            return self._relpaths[key]
+        except KeyError:
+            relpath = os.path.relpath(to_dir, from_dir)
+            result = self._relpaths[key] = '' if relpath == '.' else relpath
+            return result
+
+    def expand(self, path, rpath):
+        """
+        Return the bundle directory named by an rpath of the given file.
+        """
+        for prefix in ('@loader_path', '@executable_path'):
+            if rpath.startswith(prefix):
+                tail = rpath[len(prefix):].lstrip('/')
+                return os.path.normpath(
+                    os.path.join(os.path.dirname(path), tail))
+        if rpath.startswith('/'):
+            return bundle_path(self.root, rpath)
+        return None
+
+    def resolve(self, path, dylib, rpaths):
+        """
+        Return the path of the file in the bundle which satisfies the given
+        dependency of the file with the given path, or None.
+        """
+        basename = os.path.basename(dylib)
+        if dylib.startswith('@rpath/'):
+            for rpath in rpaths:
+                directory = self.expand(path, rpath)
+                candidate = directory and os.path.join(directory, basename)
+                if candidate in self.files:
+                    return candidate
+        elif dylib.startswith('/opt'):
+            # Special case for libgfortran on arm64, which we install in
+            # local/lib.
+            candidate = os.path.join(self.local_lib, basename)
+            if candidate in self.files:
+                return candidate
+        elif dylib.startswith('/'):
+            if dylib in self.by_name:
+                return self.by_name[dylib]
+            candidate = bundle_path(self.root, dylib)
+            if candidate in self.files:
+                return candidate
+        else:
+            return None
+        candidates = self.by_basename.get(basename, [])
+        if len(candidates) == 1:
+            return candidates[0]
+        preferred = [c for c in candidates
+                     if os.path.dirname(c) == self.local_lib]
+        return preferred[0] if len(preferred) == 1 else None
+
+    def rpaths_for(self, path):
+        """
+        Return the list of rpaths to be installed in the given file.  The
+        dependencies which cannot be resolved are recorded in
+        self.unresolved.
+        """
+        filetype, dylibs, rpaths = self.files[path]
+        if filetype == 'MH_EXECUTE':
+            prefix = '@executable_path'
+        elif filetype in ('MH_DYLIB', 'MH_BUNDLE'):
+            prefix = '@loader_path'
+        else:
+            prefix = ''
+        directory = os.path.dirname(path)
+        # Keep rpaths which are already fixed, e.g. _tkinter.
+        result = [rpath for rpath in rpaths if rpath.startswith('@loader_path')]
+        for dylib in dylibs:
+            if dylib.startswith('@') and not dylib.startswith('@rpath/'):
+                continue
+            target = self.resolve(path, dylib, rpaths)
+            if target is None:
+                self.unresolved.setdefault(path, []).append(dylib)
+                continue
+            relpath = self.relative_path(directory, os.path.dirname(target))
+            result.append(os.path.join(prefix, relpath) if relpath else prefix)
+        return unique(result)
+
+    def report(self):
+        """
+        Return a description of the unresolved dependencies.
+        """
+        lines = []
+        for path in sorted(self.unresolved):
+            lines.append('%s:'%os.path.relpath(path, self.root))
+            lines += ['    %s'%dylib for dylib in self.unresolved[path]]
+        return '\n'.join(lines)
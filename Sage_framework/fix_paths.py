@@ -1,26 +1,47 @@
 import sys
 import os
-import subprocess
 import re
+import time
+import argparse
+import shlex
+import json
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from macho import MachO, MachOError, rewrite
+from relocation_cache import RelocationCache
+from dylib_graph import DylibGraph, bundle_root, is_system, unique
+from strip_stage import StripStage, STRIP_TOOL, needs_strip
+from classify import FileTable, MACHO
+from manifest import ManifestWriter
+from tools import TOOLS
+from sign_cache import SignCache
+from sign_sage import Signer, SigningQueue, file_args, entitlement_file
 LOCAL_LIB = '/private/var/tmp/sage-X.X-current/local/lib'
+# With a sink, fixed files are stripped and passed on in batches this big.
+STREAM_BATCH = 64
 get_info = re.compile(b'Filetype: (?P<filetype>.*)| *LC_LOAD_DYLIB: (?P<dylib>.*)| *LC_RPATH: (?P<rpath>.*)')
 get_version = re.compile(r'SageMath version ([0-9]*\.[0-9]*)')
 
-# Bigendian encoding of the magic numbers for mach-O binaries
-feedface_big = b'\xfe\xed\xfa\xce'
-cafebabe_big = b'\xca\xfe\xba\xbe'
-feedfacf_big = b'\xfe\xed\xfa\xcf'
-cafebabf_big = b'\xca\xfe\xba\xbf'
-# Smallendian encodings of the magic number for mach-O binaries
-feedface = b'\xce\xfa\xed\xfe'
-cafebabe = b'\xbe\xba\xfe\xca'
-feedfacf = b'\xcf\xfa\xed\xfe'
-cafebabf = b'\xbf\xba\xfe\xca'
-
-magics = (cafebabf, feedfacf,  cafebabe_big, feedface_big, cafebabe, feedface, cafebabf_big, feedfacf_big)
-
-def unique(some_list):
-    return list(dict((x, None) for x in some_list).keys())
+def macher_info(path, tools=TOOLS):
+    """
+    Return the filetype, load paths and rpaths of a Mach-O file, as
+    reported by macher.  This is the slow path which forks a process for
+    each file.  It is kept for comparison with the macho module.
+    """
+    info = tools.run('macher', ['info', path], [path]).stdout
+    filetype = None
+    dylibs, rpaths = [], []
+    for line in info.split(b'\n'):
+        m = get_info.match(line)
+        if m is None:
+            continue
+        if m['filetype']:
+            filetype = m['filetype'].decode('ascii')
+        elif m['dylib']:
+            dylibs.append(m['dylib'].decode('ascii'))
+        elif m['rpath']:
+            rpaths.append(m['rpath'].decode('ascii'))
+    return filetype, dylibs, rpaths
 
 class MachFile:
     def __init__(self, path):
@@ -29,28 +50,11 @@ class MachFile:
         self.nodes = nodes[nodes.index('local'):]
         self.local_path = os.path.join(*nodes)
         self.depth = len(nodes)
-        info = subprocess.run(['macher', 'info', path], capture_output=True).stdout
-        self.filetype = None
-        self.dylibs = []
-        self.rpaths = []
-        for line in info.split(b'\n'):
-            m = get_info.match(line)
-            if m is None:
-                continue
-            filetype = m['filetype']
-            if filetype:
-                self.filetype = filetype.decode('ascii')
-                continue
-            dylib = m['dylib']
-            if dylib:
-                if (not dylib.startswith(b'/usr') and
-                    not dylib.startswith(b'/lib') and
-                    not dylib.startswith(b'/System')):
-                    self.dylibs.append(dylib.decode('ascii'))
-                continue
-            rpath = m['rpath']
-            if rpath:
-                self.rpaths.append(rpath.decode('ascii'))
+        macho = MachO(path)
+        self.filetype, dylibs, self.rpaths = (
+            macho.filetype, macho.dylibs, macho.rpaths)
+        self.digest = macho.commands_digest()
+        self.dylibs = [dylib for dylib in dylibs if not is_system(dylib)]
 
     def relative_path(self, path):
         """
@@ -114,114 +118,391 @@ class MachFile:
         fixed = [rpath for rpath in self.rpaths if rpath.startswith('@loader_path')]
         return fixed + unique([build_rpath(relpath) for relpath in relpaths])
 
-    def fix(self):
-        rpaths = self.fixed_rpaths()
-        subprocess.run(['macher', 'clear_rpaths', self.path], capture_output=True)
-        for rpath in rpaths:
-            subprocess.run(['macher', 'add_rpath', rpath, self.path], capture_output=True)
+    def fixed_libpaths(self):
+        """
+        Return a dict mapping each load path which needs to be changed to
+        its replacement, which is relative to @rpath.
+        """
+        result = {}
         for dylib in self.dylibs:
             if (dylib.startswith('/usr') or dylib.startswith('/lib') or
                     dylib.startswith('@rpath')):
                 continue
-            new_dylib = os.path.join('@rpath', os.path.basename(dylib))
-            subprocess.run(['macher', 'edit_libpath', dylib, new_dylib, self.path])
-        # Stripping more than this breaks the gcc stub library, but probably most executables
-        # and libraries could be stripped to -u -r without causing problems.
-        subprocess.run(['strip', '-x', self.path], capture_output=True)
-        print(self.path)
-
-class ScriptFile:
-    def __init__(self, repo, symlink, path):
-        self.path = path
-        nodes = self.path.split(os.path.sep)
-        self.sage_dir = os.path.join(repo, 'sage').encode('utf-8')
-        self.symlink = symlink
+            result[dylib] = os.path.join('@rpath', os.path.basename(dylib))
+        return result
+
+    def plan(self, install_name=None, rpaths=None):
+        """
+        Return a dict describing the edits needed to fix the file.  The
+        rpaths computed by a DylibGraph can be passed in; otherwise they
+        are computed from the current load paths and rpaths.
+        """
+        if rpaths is None:
+            rpaths = self.fixed_rpaths()
+        return {'rpaths': rpaths,
+                'libpaths': self.fixed_libpaths(),
+                'install_name': install_name}
+
+    def fix(self, install_name=None, rpaths=None):
+        """
+        Fix the file and return a dict describing the edits which were made.
+        """
+        plan = self.plan(install_name, rpaths)
+        apply_plan(self.path, plan)
+        return plan
+
+def apply_plan(path, plan):
+    # All of the load command edits are made with a single write.
+    rewrite(path, clear_rpaths=True, add_rpaths=plan['rpaths'],
+            edit_libpaths=plan['libpaths'],
+            install_name=plan['install_name'])
+
+def find_mach_files(directories, table=None):
+    """
+    Return the sorted list of Mach-O files in the given directories, using
+    the FileTable if one is given.
+    """
+    if table is None:
+        table = FileTable().scan(*directories)
+    return table.paths(MACHO, under=directories)
+
+def fix_file(path, digest=None, rpaths=None):
+    """
+    Fix the Mach-O file with the given path, unless its load commands have
+    the given digest, meaning that it was fixed already.  The rpaths may be
+    precomputed by a DylibGraph.  Return a pair (status, entry) where
+    status is 'skipped', 'unchanged', 'fixed' or 'failed' and entry
+    describes the edits made to a fixed file, or the error for a failed
+    one.  Stripping is done later, by a StripStage.
+    """
+    start = time.perf_counter()
+    try:
+        MF = MachFile(path)
+    except MachOError as e:
+        print('Skipping %s: %s'%(path, e), file=sys.stderr)
+        return 'skipped', None
+    if digest is not None and MF.digest == digest:
+        return 'unchanged', None
+    #if MF.filetype == "MH_DYLIB":
+    #    id_path = os.path.join("@rpath", os.path.split(path)[1])
+    #    entry = MF.fix(install_name=id_path, rpaths=rpaths)
+    #else:
+    try:
+        entry = MF.fix(rpaths=rpaths)
+    except (MachOError, RuntimeError) as e:
+        # The load commands are only written if all of the edits fit.
+        return 'failed', str(e)
+    entry['seconds'] = time.perf_counter() - start
+    return 'fixed', entry
 
-    def fix(self):
+def set_local_lib(local_lib):
+    # Worker processes are spawned on macOS, so they do not inherit the
+    # value computed in __main__.
+    global LOCAL_LIB
+    LOCAL_LIB = local_lib
+
+#def fix_files(repo, symlink, directories):
+def fix_files(repo, directories, jobs=1, cache=None, graph=None,
+              strict=False, strip=None, table=None, sink=None,
+              failures=None):
+    """
+    Fix every Mach-O file in the given directories, using a pool of worker
+    processes if jobs > 1.  Files which the RelocationCache reports as
+    already fixed are not touched.  If a DylibGraph of the bundle is
+    given, the rpaths are computed from it and unresolved dependencies
+    are reported before any file is written; with strict=True they are
+    fatal.  The fixed files are then stripped by the StripStage, if one
+    is given.  Return the sorted list of fixed paths, including the cached
+    ones, so that the output does not depend on the number of jobs or on
+    the state of the cache.  A file which cannot be fixed is reported and
+    left alone, and its path is appended to the failures list, if given.
+
+    If a sink is given it is called with each path as soon as that file
+    is finished, so that a later stage such as signing can start while
+    the remaining files are being fixed.  Fixed files are then stripped
+    in batches of STREAM_BATCH as their workers finish, rather than all
+    at once at the end.
+    """
+    if isinstance(directories, str):
+        directories = [directories]
+    emit = sink or (lambda path: None)
+    fixed, todo, digests = [], [], []
+    for path in find_mach_files(directories, table):
+        hit, digest = cache.lookup(path) if cache else (False, None)
+        if hit:
+            cache.hit(path)
+            fixed.append(path)
+            emit(path)
+        else:
+            todo.append(path)
+            digests.append(digest)
+    rpaths = [None]*len(todo)
+    if graph is not None:
+        rpaths = [graph.rpaths_for(path) if path in graph.files else None
+                  for path in todo]
+        if graph.unresolved:
+            print('Unresolved dependencies:', file=sys.stderr)
+            print(graph.report(), file=sys.stderr)
+            if strict:
+                raise RuntimeError('%d files have unresolved dependencies'%
+                                   len(graph.unresolved))
+    entries = {}
+    def finish():
+        stripped = set(strip.run(sorted(entries))) if strip else set()
+        for path, entry in entries.items():
+            entry['strip'] = path in stripped
+            if cache is not None:
+                st = os.stat(path)
+                entry.update(size=st.st_size, mtime=st.st_mtime_ns,
+                             digest=MachO(path).commands_digest())
+                cache.miss(path, entry)
+            emit(path)
+        entries.clear()
+    pool = None
+    if jobs > 1:
+        pool = ProcessPoolExecutor(jobs, initializer=set_local_lib,
+                                   initargs=(LOCAL_LIB,))
+        results = pool.map(fix_file, todo, digests, rpaths, chunksize=16)
+    else:
+        results = map(fix_file, todo, digests, rpaths)
+    try:
+        for path, (status, entry) in zip(todo, results):
+            if status == 'skipped':
+                continue
+            if status == 'failed':
+                print('Cannot fix %s: %s'%(path, entry), file=sys.stderr)
+                if failures is not None:
+                    failures.append(path)
+                continue
+            fixed.append(path)
+            if status == 'unchanged':
+                if cache is not None:
+                    cache.hit(path)
+                emit(path)
+            else:
+                entries[path] = entry
+                if sink is not None and len(entries) >= STREAM_BATCH:
+                    finish()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    finish()
+    return sorted(fixed)
+
+def plan_files(root, directories, graph, table=None):
+    """
+    Return the list of edits which fix_files would make, one dict per
+    Mach-O file, without modifying anything, and a dict mapping the path
+    of each record to the digest of the file's load commands.  Paths are
+    relative to the bundle root, so that plans for different Sage versions
+    can be diffed; the digests, which change with every build, are kept
+    out of the records for the same reason.
+    """
+    records, digests = [], {}
+    for path in find_mach_files(directories, table):
         try:
-            with open(self.path, 'rb') as infile:
-                shebang = infile.readline()
-                rest = infile.read()
-                tail = shebang.split(b'/local/')[1]
-                new_shebang = b'#!' + os.path.join(self.symlink, b'local', tail)
-        except:
-            new_shebang = shebang
-        with open(self.path, 'wb') as outfile:
-            outfile.write(new_shebang + b'\n')
-            outfile.write(rest.replace(self.sage_dir, self.symlink))
-
-class ConfigFile:
-    def __init__(self, repo, symlink, path):
-        self.path = path
-        nodes = self.path.split(os.path.sep)
-        self.sage_dir = os.path.join(repo, 'sage').encode('utf-8')
-        self.symlink = symlink
-
-    def fix(self):
-        with open(self.path, 'rb') as infile:
-            contents = infile.read()
-        with open(self.path, 'wb') as outfile:
-            outfile.write(contents.replace(self.sage_dir, self.symlink))
-
-def mach_check(path):
-    if os.path.islink(path):
-        return False
-    with open(path, 'rb') as inputfile:
-        magic = inputfile.read(4)
-    return magic in magics
-
-def shebang_check(path):
-    if os.path.islink(path):
-        return False
-    with open(path, 'rb') as inputfile:
-        first = inputfile.read(2)
-    return first == b'#!'
-
-# These files need to be fixed as ConfigFiles as well.
-MAKEFILE = 'python3.9/config-3.9-darwin/Makefile'
-DARWIN_DATA = 'python3.9/_sysconfigdata__darwin_darwin.py'
-SAGE_CONFIG = 'python3.9/site-packages/sage_conf.py'
-
-#def fix_files(repo, symlink, directory):
-def fix_files(repo, directory):
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            fullpath = os.path.join(dirpath, filename)
-            if mach_check(fullpath):
-                MF = MachFile(fullpath)
-                MF.fix()
-                #if MF.filetype == "MH_DYLIB":
-                #    id_path = os.path.join("@rpath", os.path.split(fullpath)[1])
-                #    subprocess.run(['macher', 'set_id', id_path, fullpath])
-            # elif shebang_check(fullpath):
-            #     ScriptFile(repo, symlink, fullpath).fix()
-            # elif (fullpath.endswith('.pc') or
-            #         fullpath.endswith(MAKEFILE) or
-            #         fullpath.endswith(DARWIN_DATA) or
-            #         fullpath.endswith(SAGE_CONFIG)):
-            #     ConfigFile(repo, symlink, fullpath).fix()
-
-# def fix_config_files(directory):
-#     for dirpath, dirnames, filenames in os.walk(directory):
-#         for filename in filenames:
-#             fullpath = os.path.join(dirpath, filename)
-#             ConfigFile(fullpath).fix()
-
-# def fix_scripts(directory):
-#     for dirpath, dirnames, filenames in os.walk(directory):
-#         for filename in filenames:
-#             fullpath = os.path.join(dirpath, filename)
-#             if shebang_check(fullpath):
-#                 ScriptFile(fullpath).fix()
+            MF = MachFile(path)
+        except MachOError as e:
+            print('Skipping %s: %s'%(path, e), file=sys.stderr)
+            continue
+        rpaths = graph.rpaths_for(path) if path in graph.files else None
+        record = {'path': os.path.relpath(path, root),
+                  'filetype': MF.filetype,
+                  'clear_rpaths': MF.rpaths}
+        record.update(MF.plan(rpaths=rpaths))
+        record['strip'] = needs_strip(path)
+        records.append(record)
+        digests[record['path']] = MF.digest
+    return records, digests
 
-if __name__ == '__main__':
+def digests_path(plan_path):
+    """The sidecar file which holds the digests for a plan."""
+    return plan_path + '.digests'
+
+def write_plan(plan_path, root, records, digests):
+    """
+    Write a plan as JSON lines.  The first line records the bundle root.
+    The digests, which apply_record checks, are written to a sidecar file.
+    """
+    with open(plan_path, 'w') as outfile:
+        outfile.write(json.dumps({'root': root}) + '\n')
+        for record in records:
+            outfile.write(json.dumps(record, sort_keys=True) + '\n')
+    with open(digests_path(plan_path), 'w') as outfile:
+        json.dump(digests, outfile, indent=0, sort_keys=True)
+
+def read_plan(plan_path):
+    """
+    Return the root, the records and the digests of a plan.  Without the
+    sidecar file the digests are empty and no file is checked.
+    """
+    with open(plan_path) as infile:
+        root = json.loads(infile.readline())['root']
+        records = [json.loads(line) for line in infile if line.strip()]
     try:
-        repo, directory = sys.argv[1], sys.argv[2]
-    except IndexError:
-        print('Usage python3 fixpaths.py repo <directory>')
+        with open(digests_path(plan_path)) as infile:
+            digests = json.load(infile)
+    except FileNotFoundError:
+        print('No digests for %s; files will not be checked'%plan_path,
+              file=sys.stderr)
+        digests = {}
+    return root, records, digests
+
+def apply_record(root, record, digest=None):
+    """
+    Make the load command edits in one record of a plan.  Return the path,
+    or None if the file no longer has the given digest, meaning that it
+    has changed since the plan was made.
+    """
+    path = os.path.join(root, record['path'])
+    try:
+        current = MachO(path).commands_digest()
+    except (OSError, MachOError) as e:
+        print('Skipping %s: %s'%(path, e), file=sys.stderr)
+        return None
+    if digest is not None and current != digest:
+        print('Skipping %s: it changed after the plan was made'%path,
+              file=sys.stderr)
+        return None
+    apply_plan(path, record)
+    return path
+
+def apply_plan_file(plan_path, jobs=1, strip=None):
+    """
+    Execute a plan written by write_plan, using at most jobs worker
+    processes.  Return the sorted list of fixed paths.
+    """
+    root, records, digests = read_plan(plan_path)
+    roots = [root]*len(records)
+    guards = [digests.get(record['path']) for record in records]
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(apply_record, roots, records, guards,
+                                    chunksize=16))
+    else:
+        results = list(map(apply_record, roots, records, guards))
+    if strip:
+        strip.run(sorted(path for path, record in zip(results, records)
+                         if path and record['strip']))
+    return sorted(path for path in results if path)
+
+def main():
+    global LOCAL_LIB
+    parser = argparse.ArgumentParser(
+        description='Make the rpaths and load paths of all Mach-O files '
+        'in the given directories relative, and print the fixed paths.')
+    parser.add_argument('repo', nargs='?')
+    parser.add_argument('directories', nargs='*', metavar='directory')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--cache', default='fix_paths_cache.json',
+                        help='relocation cache file (default: %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='fix every file, ignoring the relocation cache')
+    parser.add_argument('--strip-tool', default=' '.join(STRIP_TOOL),
+                        help='command used to strip local symbols '
+                        '(default: %(default)s)')
+    parser.add_argument('--table',
+                        help='file classification cache, shared with '
+                        'fix_scripts and relativize_links')
+    parser.add_argument('--strict', action='store_true',
+                        help='do not fix anything if a dependency cannot '
+                        'be found in the bundle')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='write a JSON lines record for each fixed file '
+                        'to FILE, as soon as it is finished')
+    parser.add_argument('--sign', action='store_true',
+                        help='sign each fixed file as soon as it is '
+                        'finished, using $DEV_ID and the sign_sage cache')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--plan', metavar='PLAN',
+                      help='write the edits to PLAN as JSON lines instead '
+                      'of making them, and the digests which --apply checks '
+                      'to PLAN.digests')
+    mode.add_argument('--apply', metavar='PLAN',
+                      help='make the edits in PLAN, ignoring the cache')
+    args = parser.parse_args()
+    strip = StripStage(shlex.split(args.strip_tool), args.jobs)
+    manifest = ManifestWriter(args.manifest, 'w') if args.manifest else None
+    queue = None
+    if args.sign:
+        dev_id = os.environ['DEV_ID']
+        sign_cache = SignCache('sign_cache.json', dev_id, entitlement_file)
+        queue = SigningQueue(Signer(file_args(dev_id), args.jobs,
+                                    log_path='fix_paths_sign_log.jsonl',
+                                    cache=sign_cache))
+    def sink(path):
+        if manifest:
+            manifest.add(path)
+        if queue:
+            queue.put(path)
+    def finish_stream():
+        if manifest:
+            manifest.close()
+        if queue is None:
+            return
+        # The standard output is reserved for the list of fixed files.
+        with contextlib.redirect_stdout(sys.stderr):
+            failures = queue.close()
+        if failures:
+            print('%d signatures failed'%failures,
+                  file=sys.stderr)
+            sys.exit(1)
+    if args.apply:
+        for path in apply_plan_file(args.apply, args.jobs, strip):
+            print(path)
+            sink(path)
+        print(strip.report(), file=sys.stderr)
+        finish_stream()
+        return
+    if not args.directories:
+        parser.error('a repo and at least one directory are required')
+    repo = args.repo
     with open(os.path.join(repo, 'sage', 'VERSION.txt')) as input_file:
         m = get_version.match(input_file.readline())
     sage_version = m.groups()[0]
     LOCAL_LIB = LOCAL_LIB.replace('X.X', sage_version)
     repo = os.path.abspath(repo)
-    fix_files(repo, directory)
+    directories = [os.path.abspath(d) for d in args.directories]
+    # Index every Mach-O file in the bundle, not just the ones being fixed.
+    root = bundle_root(directories[0])
+    local = os.path.join(root, 'local')
+    table = FileTable(args.table).scan(local, *[d for d in directories
+        if not d.startswith(local + os.path.sep)])
+    graph = DylibGraph(root, LOCAL_LIB)
+    for path in table.paths(MACHO):
+        graph.add(path)
+    if args.plan:
+        records, digests = plan_files(root, directories, graph, table)
+        write_plan(args.plan, root, records, digests)
+        if graph.unresolved:
+            print('Unresolved dependencies:', file=sys.stderr)
+            print(graph.report(), file=sys.stderr)
+        print('Planned edits for %d files'%len(records), file=sys.stderr)
+        return
+    cache = RelocationCache(args.cache, LOCAL_LIB, force=args.force)
+    failures = []
+    try:
+        fixed = fix_files(repo, directories, args.jobs, cache, graph,
+                          args.strict, strip, table,
+                          sink if manifest or queue else None, failures)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        # Keep the record of the files which were fixed before any error.
+        cache.save()
+    for path in fixed:
+        print(path)
+    print(strip.report(), file=sys.stderr)
+    if args.table:
+        table.save()
+    print(cache.summary(), file=sys.stderr)
+    finish_stream()
+    print(TOOLS.summary(), file=sys.stderr)
+    if failures:
+        print('%d files could not be fixed'%len(failures), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
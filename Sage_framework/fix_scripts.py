@@ -1,43 +1,117 @@
-import sys
+"""
+Point the shebang of every script in a directory at the /var/tmp symlink
+for the Sage version which contains it.
+
+Only the first line of each script is read, in binary mode, so scripts
+which are not valid UTF-8 are handled.  A script is rewritten only if
+its interpreter changes: the new first line and the rest of the file are
+copied to a temporary file which then replaces the original, keeping its
+mode.  The scripts are examined by a pool of worker threads.
+
+Usage: python3 fix_scripts.py [--jobs N] [--table FILE] directory
+"""
+
 import os
+import stat
+import shutil
+import tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from classify import FileTable, SCRIPT
+
+COPY_BUFFER = 1 << 20
+
+def copy_rest(infile, fd):
+    """
+    Copy the rest of an open file, from its current position, to the
+    file descriptor fd.
+    """
+    offset = infile.tell()
+    if hasattr(os, 'copy_file_range'):
+        src = infile.fileno()
+        while True:
+            try:
+                count = os.copy_file_range(src, fd, COPY_BUFFER, offset)
+            except OSError:
+                break
+            if not count:
+                return
+            offset += count
+    infile.seek(offset)
+    with open(fd, 'wb', closefd=False) as outfile:
+        shutil.copyfileobj(infile, outfile, COPY_BUFFER)
 
 class ScriptFile:
     def __init__(self, fullpath):
         self.fullpath = fullpath
 
     def fix_shebang(self, shebang):
-        nodes = shebang.split(os.path.sep)
-        m = nodes.index('Versions')
+        """
+        Return the new first line, or None if the interpreter is not in a
+        versioned framework directory.
+        """
+        line = shebang.rstrip(b'\r\n')
+        ending = shebang[len(line):]
+        nodes = line.split(b'/')
+        try:
+            m = nodes.index(b'Versions')
+        except ValueError:
+            return None
+        if m + 2 >= len(nodes):
+            return None
         sage_version = nodes[m+1]
-        tail = os.path.join(*nodes[m+2:])
-        return '#!/var/tmp/sage-%s-current/'%sage_version + tail
-        
+        tail = b'/'.join(nodes[m+2:])
+        return b'#!/var/tmp/sage-%s-current/'%sage_version + tail + ending
+
     def fix(self):
-        with open(self.fullpath, 'r') as infile:
+        """
+        Rewrite the script if its shebang changes.  Return True if it did.
+        """
+        with open(self.fullpath, 'rb') as infile:
             shebang = infile.readline()
-            rest = infile.read()
-        new_shebang = self.fix_shebang(shebang)
-        with open(self.fullpath, 'w') as outfile:
-            outfile.write(new_shebang + '\n')
-            outfile.write(rest)
-
-def shebang_check(path):
-    if os.path.islink(path):
-        return False
-    with open(path, 'rb') as inputfile:
-        first = inputfile.read(2)
-    return first == b'#!'
-
-def fix_scripts(directory):
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            fullpath = os.path.join(dirpath, filename)
-            if shebang_check(fullpath):
-                ScriptFile(fullpath).fix()
+            new_shebang = self.fix_shebang(shebang)
+            if new_shebang is None or new_shebang == shebang:
+                return False
+            dirname, name = os.path.split(self.fullpath)
+            fd, temp = tempfile.mkstemp(prefix='.%s.'%name, dir=dirname)
+            try:
+                os.write(fd, new_shebang)
+                copy_rest(infile, fd)
+                mode = stat.S_IMODE(os.fstat(infile.fileno()).st_mode)
+                os.fchmod(fd, mode)
+            except BaseException:
+                os.close(fd)
+                os.unlink(temp)
+                raise
+        os.close(fd)
+        os.replace(temp, self.fullpath)
+        return True
+
+def fix_scripts(directory, table=None, jobs=8):
+    """
+    Fix the shebangs of the scripts below a directory, and return the
+    sorted list of scripts which were changed.
+    """
+    if table is None:
+        table = FileTable().scan(directory)
+    paths = table.paths(SCRIPT, under=[directory])
+    with ThreadPoolExecutor(jobs) as pool:
+        changed = list(pool.map(lambda path: ScriptFile(path).fix(), paths))
+    return [path for path, fixed in zip(paths, changed) if fixed]
 
 if __name__ == '__main__':
-    try:
-        directory = sys.argv[1]
-    except IndexError:
-        print('Usage python3 fixscripts.py <directory>')
-    fix_scripts(directory)
+    parser = argparse.ArgumentParser(
+        description='Point the shebangs of the scripts in a directory at '
+        'the /var/tmp symlink.')
+    parser.add_argument('directory')
+    parser.add_argument('--jobs', '-j', type=int, default=8,
+                        help='number of worker threads')
+    parser.add_argument('--table',
+                        help='file classification cache, shared with '
+                        'fix_paths and relativize_links')
+    args = parser.parse_args()
+    table = FileTable(args.table).scan(args.directory)
+    changed = fix_scripts(args.directory, table, args.jobs)
+    print('Fixed the shebangs of %d scripts'%len(changed))
+    if args.table:
+        table.save()
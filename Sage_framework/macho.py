@@ -0,0 +1,555 @@
+"""
+A minimal, pure Python reader for Mach-O files.
+
+Only the fat header, the Mach-O headers and the load command region of
+each architecture are read, using bounded reads.  This is all that
+fix_paths needs to know in order to relocate a binary, and it avoids
+forking a macher process for every file in the framework.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+
+# Magic numbers, as unsigned 32 bit integers.
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+# The values read with the wrong byte order.
+MH_CIGAM = 0xcefaedfe
+MH_CIGAM_64 = 0xcffaedfe
+FAT_CIGAM = 0xbebafeca
+FAT_CIGAM_64 = 0xbfbafeca
+
+THIN_MAGICS = (MH_MAGIC, MH_MAGIC_64)
+FAT_MAGICS = (FAT_MAGIC, FAT_MAGIC_64)
+
+# A Java class file also starts with 0xcafebabe.  The next word is then
+# its version number, which is much larger than any plausible number of
+# architectures in a fat file.
+MAX_FAT_ARCHS = 30
+
+FILETYPES = {
+    0x1: 'MH_OBJECT',
+    0x2: 'MH_EXECUTE',
+    0x3: 'MH_FVMLIB',
+    0x4: 'MH_CORE',
+    0x5: 'MH_PRELOAD',
+    0x6: 'MH_DYLIB',
+    0x7: 'MH_DYLINKER',
+    0x8: 'MH_BUNDLE',
+    0x9: 'MH_DYLIB_STUB',
+    0xa: 'MH_DSYM',
+    0xb: 'MH_KEXT_BUNDLE',
+}
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_TYPES = {
+    7: 'i386',
+    7 | CPU_ARCH_ABI64: 'x86_64',
+    12: 'arm',
+    12 | CPU_ARCH_ABI64: 'arm64',
+    18: 'ppc',
+    18 | CPU_ARCH_ABI64: 'ppc64',
+}
+
+# Load commands
+LC_REQ_DYLD = 0x80000000
+LC_SEGMENT = 0x1
+LC_SYMTAB = 0x2
+LC_DYSYMTAB = 0xb
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_SEGMENT_64 = 0x19
+LC_CODE_SIGNATURE = 0x1d
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+
+# Load commands which refer to a dylib by its install name.
+DYLIB_COMMANDS = (LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB,
+                  LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB, LC_ID_DYLIB)
+
+# Symbol types
+N_STAB = 0xe0
+N_EXT = 0x01
+
+# Section types which occupy no space in the file.
+S_ZEROFILL = 0x1
+S_GB_ZEROFILL = 0xc
+S_THREAD_LOCAL_ZEROFILL = 0x12
+ZEROFILL_TYPES = (S_ZEROFILL, S_GB_ZEROFILL, S_THREAD_LOCAL_ZEROFILL)
+
+class MachOError(RuntimeError):
+    pass
+
+class LoadCommand:
+    """
+    A load command from a Mach-O header.  The offset is relative to the
+    start of the architecture slice which contains the command, and data
+    holds the complete command, including the cmd and cmdsize fields.
+    """
+    def __init__(self, cmd, offset, data):
+        self.cmd = cmd
+        self.offset = offset
+        self.data = data
+
+    def __repr__(self):
+        return '<LoadCommand 0x%x at %d, size %d>'%(
+            self.cmd, self.offset, len(self.data))
+
+    @property
+    def size(self):
+        return len(self.data)
+
+class MachHeader:
+    """
+    The header and load commands of one architecture in a Mach-O file.
+    """
+    def __init__(self, offset, size, header, commands_data):
+        self.offset = offset
+        self.size = size
+        magic = struct.unpack('<I', header[:4])[0]
+        if magic in THIN_MAGICS:
+            self.endian = '<'
+        elif magic in (MH_CIGAM, MH_CIGAM_64):
+            self.endian = '>'
+        else:
+            raise MachOError('Bad Mach-O magic 0x%x at offset %d'%(
+                magic, offset))
+        self.is_64 = magic in (MH_MAGIC_64, MH_CIGAM_64)
+        self.header_size = 32 if self.is_64 else 28
+        (self.magic, self.cputype, self.cpusubtype, self.filetype_code,
+         self.ncmds, self.sizeofcmds, self.flags) = struct.unpack(
+             self.endian + '7I', header[:28])
+        self.header = header[:self.header_size]
+        self.commands = []
+        position = 0
+        for n in range(self.ncmds):
+            if position + 8 > len(commands_data):
+                raise MachOError('Truncated load command %d at offset %d'%(
+                    n, offset))
+            cmd, cmdsize = struct.unpack_from(self.endian + '2I',
+                                              commands_data, position)
+            if cmdsize < 8 or position + cmdsize > len(commands_data):
+                raise MachOError('Load command %d has bad size %d'%(
+                    n, cmdsize))
+            self.commands.append(LoadCommand(cmd,
+                self.header_size + position,
+                commands_data[position:position + cmdsize]))
+            position += cmdsize
+
+    @property
+    def filetype(self):
+        return FILETYPES.get(self.filetype_code,
+                             'UNKNOWN(0x%x)'%self.filetype_code)
+
+    @property
+    def arch(self):
+        return CPU_TYPES.get(self.cputype, 'cpu%d'%self.cputype)
+
+    def unpack(self, fmt, data, offset=0):
+        return struct.unpack_from(self.endian + fmt, data, offset)
+
+    def lc_str(self, command):
+        """
+        Return the string referenced by the first lc_str field of a
+        command.  This is the dylib name, or the rpath.
+        """
+        str_offset = self.unpack('I', command.data, 8)[0]
+        raw = command.data[str_offset:]
+        return raw.split(b'\0', 1)[0].decode('utf-8')
+
+    def lc_str_command(self, cmd, string, fixed=b''):
+        """
+        Build a load command consisting of the given fixed fields followed
+        by a single lc_str, padded to the required alignment.
+        """
+        align = 8 if self.is_64 else 4
+        str_offset = 12 + len(fixed)
+        encoded = string.encode('utf-8')
+        size = (str_offset + len(encoded) + align) & ~(align - 1)
+        data = struct.pack(self.endian + '3I', cmd, size, str_offset)
+        data += fixed + encoded
+        return data + b'\0'*(size - len(data))
+
+    def edited(self, clear_rpaths=False, add_rpaths=(), edit_libpaths=None,
+               install_name=None):
+        """
+        Return the new header and load commands, as bytes, which result
+        from applying the given edits, or None if nothing changes.  The
+        result is long enough to overwrite the old load commands.  Raises
+        MachOError if the new load commands do not fit in the space
+        available before the first section.
+        """
+        edit_libpaths = edit_libpaths or {}
+        commands = []
+        rpaths = []
+        for command in self.commands:
+            if command.cmd == LC_RPATH:
+                if clear_rpaths:
+                    continue
+                rpaths.append(self.lc_str(command))
+            elif command.cmd == LC_ID_DYLIB and install_name is not None:
+                command = LoadCommand(command.cmd, command.offset,
+                    self.lc_str_command(command.cmd, install_name,
+                                        command.data[12:24]))
+            elif command.cmd in DYLIB_COMMANDS and command.cmd != LC_ID_DYLIB:
+                new_name = edit_libpaths.get(self.lc_str(command))
+                if new_name is not None:
+                    command = LoadCommand(command.cmd, command.offset,
+                        self.lc_str_command(command.cmd, new_name,
+                                            command.data[12:24]))
+            commands.append(command.data)
+        # New rpaths go before the code signature, which codesign keeps
+        # last, so refixing a signed file which is already fixed changes
+        # nothing.
+        signature = [n for n, data in enumerate(commands)
+                     if struct.unpack(self.endian + 'I', data[:4])[0] ==
+                     LC_CODE_SIGNATURE]
+        position = signature[0] if signature else len(commands)
+        # dyld refuses to load a file with duplicate rpaths.
+        for rpath in add_rpaths:
+            if rpath not in rpaths:
+                rpaths.append(rpath)
+                commands.insert(position, self.lc_str_command(LC_RPATH, rpath))
+                position += 1
+        new_commands = b''.join(commands)
+        old_commands = b''.join(command.data for command in self.commands)
+        if new_commands == old_commands:
+            return None
+        available = self.payload_start - self.header_size
+        if len(new_commands) > available:
+            raise MachOError(
+                '%s load commands need %d bytes but only %d are available '
+                'before the first section'%(
+                    self.arch, len(new_commands), available))
+        header = bytearray(self.header)
+        struct.pack_into(self.endian + '2I', header, 16, len(commands),
+                         len(new_commands))
+        fill = max(0, self.sizeofcmds - len(new_commands))
+        return bytes(header) + new_commands + b'\0'*fill
+
+    def strings(self, *cmds):
+        return [self.lc_str(command) for command in self.commands
+                if command.cmd in cmds]
+
+    @property
+    def dylibs(self):
+        return self.strings(LC_LOAD_DYLIB)
+
+    @property
+    def rpaths(self):
+        return self.strings(LC_RPATH)
+
+    @property
+    def install_name(self):
+        names = self.strings(LC_ID_DYLIB)
+        return names[0] if names else None
+
+    def sections(self):
+        """
+        Generate (segname, sectname, offset, size, flags) for each section.
+        """
+        if self.is_64:
+            seg_fmt, seg_size, sect_fmt, sect_size = (
+                '16s4Q4I', 72, '16s16s2Q5I', 80)
+        else:
+            seg_fmt, seg_size, sect_fmt, sect_size = (
+                '16s4I4I', 56, '16s16s2I5I', 68)
+        for command in self.commands:
+            if command.cmd not in (LC_SEGMENT, LC_SEGMENT_64):
+                continue
+            nsects = self.unpack(seg_fmt, command.data, 8)[7]
+            for n in range(nsects):
+                (sectname, segname, _, size, offset, _, _, _,
+                 flags) = self.unpack(sect_fmt, command.data,
+                                      seg_size + n*sect_size)
+                yield (segname.rstrip(b'\0').decode('ascii'),
+                       sectname.rstrip(b'\0').decode('ascii'),
+                       offset, size, flags)
+
+    def segments(self):
+        """
+        Generate (segname, fileoff, filesize) for each segment.
+        """
+        for command in self.commands:
+            if command.cmd == LC_SEGMENT_64:
+                segname, _, _, fileoff, filesize = self.unpack(
+                    '16s4Q', command.data, 8)
+            elif command.cmd == LC_SEGMENT:
+                segname, _, _, fileoff, filesize = self.unpack(
+                    '16s4I', command.data, 8)
+            else:
+                continue
+            yield segname.rstrip(b'\0').decode('ascii'), fileoff, filesize
+
+    def command(self, cmd):
+        """
+        Return the first load command of the given type, or None.
+        """
+        for command in self.commands:
+            if command.cmd == cmd:
+                return command
+        return None
+
+    def local_symbol_count(self, infile):
+        """
+        Return the number of local symbols in the symbol table.  This is
+        read from LC_DYSYMTAB if present, otherwise the symbol table itself
+        is read from the open file.
+        """
+        symtab = self.command(LC_SYMTAB)
+        if symtab is None:
+            return 0
+        symoff, nsyms = self.unpack('2I', symtab.data, 8)
+        dysymtab = self.command(LC_DYSYMTAB)
+        if dysymtab is not None:
+            return self.unpack('I', dysymtab.data, 12)[0]
+        nlist_size = 16 if self.is_64 else 12
+        infile.seek(self.offset + symoff)
+        table = infile.read(nsyms*nlist_size)
+        return sum(1 for n in range(len(table)//nlist_size)
+                   if not table[n*nlist_size + 4] & N_EXT)
+
+    @property
+    def code_signature(self):
+        """
+        The (dataoff, datasize) of the code signature, or None.
+        """
+        command = self.command(LC_CODE_SIGNATURE)
+        if command is None:
+            return None
+        return self.unpack('2I', command.data, 8)
+
+    def unsigned_commands(self):
+        """
+        Return the load commands as they would be without a code signature:
+        LC_CODE_SIGNATURE is omitted and the sizes of the __LINKEDIT
+        segment, which grow to cover the signature, are zeroed.
+        """
+        if self.is_64:
+            segment, sizes = LC_SEGMENT_64, ((32, 40), (48, 56))
+        else:
+            segment, sizes = LC_SEGMENT, ((28, 32), (36, 40))
+        result = []
+        for command in self.commands:
+            if command.cmd == LC_CODE_SIGNATURE:
+                continue
+            data = command.data
+            if (command.cmd == segment and
+                    data[8:24].rstrip(b'\0') == b'__LINKEDIT'):
+                data = bytearray(data)
+                for start, end in sizes:
+                    data[start:end] = bytes(end - start)
+                data = bytes(data)
+            result.append(data)
+        return result
+
+    @property
+    def commands_end(self):
+        return self.header_size + self.sizeofcmds
+
+    @property
+    def payload_start(self):
+        """
+        The offset of the first byte of file data following the load
+        commands.  The load commands can grow up to this point.
+        """
+        starts = [offset for _, _, offset, size, flags in self.sections()
+                  if size and offset and flags & 0xff not in ZEROFILL_TYPES]
+        starts += [fileoff for _, fileoff, filesize in self.segments()
+                   if fileoff and filesize]
+        return min(starts) if starts else self.size
+
+    @property
+    def padding(self):
+        """
+        The number of unused bytes following the load commands.
+        """
+        return self.payload_start - self.commands_end
+
+class MachO:
+    """
+    The load command region of a thin or fat Mach-O file.  Each
+    architecture is represented by a MachHeader in the list self.headers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.headers = []
+        with open(path, 'rb') as infile:
+            size = os.fstat(infile.fileno()).st_size
+            start = infile.read(8)
+            if len(start) < 8:
+                raise MachOError('%s is too small to be a Mach-O file'%path)
+            magic, nfat_arch = struct.unpack('>2I', start)
+            if magic in FAT_MAGICS:
+                self.fat = True
+                self.fat_magic = magic
+                if nfat_arch > MAX_FAT_ARCHS:
+                    raise MachOError('%s is not a fat Mach-O file'%path)
+                arch_size = 32 if magic == FAT_MAGIC_64 else 20
+                table = infile.read(nfat_arch*arch_size)
+                for n in range(nfat_arch):
+                    if magic == FAT_MAGIC_64:
+                        _, _, offset, slice_size, _ = struct.unpack_from(
+                            '>2I2QI', table, n*arch_size)
+                    else:
+                        _, _, offset, slice_size, _ = struct.unpack_from(
+                            '>5I', table, n*arch_size)
+                    self.headers.append(
+                        self._read_header(infile, offset, slice_size))
+            else:
+                self.fat = False
+                self.fat_magic = None
+                self.headers.append(self._read_header(infile, 0, size))
+
+    @staticmethod
+    def _read_header(infile, offset, size):
+        infile.seek(offset)
+        header = infile.read(32)
+        if len(header) < 28:
+            raise MachOError('Truncated Mach-O header at offset %d'%offset)
+        magic = struct.unpack('<I', header[:4])[0]
+        if magic in (MH_MAGIC_64, MH_CIGAM_64, MH_MAGIC, MH_CIGAM):
+            endian = '<' if magic in THIN_MAGICS else '>'
+            sizeofcmds = struct.unpack(endian + 'I', header[20:24])[0]
+        else:
+            raise MachOError('Bad Mach-O magic 0x%x at offset %d'%(
+                magic, offset))
+        header_size = 32 if magic in (MH_MAGIC_64, MH_CIGAM_64) else 28
+        if header_size + sizeofcmds > size:
+            raise MachOError('Load commands extend beyond offset %d'%(
+                offset + size))
+        infile.seek(offset + header_size)
+        commands_data = infile.read(sizeofcmds)
+        return MachHeader(offset, size, header, commands_data)
+
+    def commands_digest(self):
+        """
+        Return a hash of the load commands of all architectures which,
+        like unsigned_digest, does not depend on the code signature.
+        """
+        sha = hashlib.sha256()
+        for header in self.headers:
+            sha.update(struct.pack('<4I', header.cputype, header.cpusubtype,
+                                   header.filetype_code, header.flags))
+            for command in header.unsigned_commands():
+                sha.update(command)
+        return sha.hexdigest()
+
+    def unsigned_digest(self):
+        """
+        Return a hash of the whole file which does not depend on its code
+        signature, so it is the same before and after codesign.  For each
+        architecture the header fields which codesign does not change, the
+        unsigned load commands and the data from the first section up to
+        the signature are hashed, ignoring trailing zeros.
+        """
+        sha = hashlib.sha256()
+        with open(self.path, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                for header in self.headers:
+                    sha.update(struct.pack('<3I', header.cputype,
+                        header.cpusubtype, header.filetype_code))
+                    sha.update(struct.pack('<I', header.flags))
+                    for command in header.unsigned_commands():
+                        sha.update(command)
+                    signature = header.code_signature
+                    end = signature[0] if signature else header.size
+                    start = header.offset + header.payload_start
+                    end = min(header.offset + end, len(data))
+                    while end > start and not data[end - 1]:
+                        end -= 1
+                    with memoryview(data) as view:
+                        sha.update(view[start:end])
+        return sha.hexdigest()
+
+    def signature_digest(self):
+        """
+        Return a hash of the code signatures of all architectures, or None
+        if any architecture is unsigned.
+        """
+        sha = hashlib.sha256()
+        with open(self.path, 'rb') as infile:
+            for header in self.headers:
+                if header.code_signature is None:
+                    return None
+                dataoff, datasize = header.code_signature
+                infile.seek(header.offset + dataoff)
+                sha.update(infile.read(datasize))
+        return sha.hexdigest()
+
+    def has_local_symbols(self):
+        """
+        Return True if any architecture has local symbols, i.e. if the file
+        would be changed by strip -x.
+        """
+        with open(self.path, 'rb') as infile:
+            return any(header.local_symbol_count(infile)
+                       for header in self.headers)
+
+    def _unique(self, attribute):
+        result = {}
+        for header in self.headers:
+            for item in getattr(header, attribute):
+                result[item] = None
+        return list(result)
+
+    @property
+    def filetype(self):
+        return self.headers[0].filetype if self.headers else None
+
+    @property
+    def archs(self):
+        return [header.arch for header in self.headers]
+
+    @property
+    def dylibs(self):
+        """LC_LOAD_DYLIB names from all architectures, without repetitions."""
+        return self._unique('dylibs')
+
+    @property
+    def rpaths(self):
+        """LC_RPATH entries from all architectures, without repetitions."""
+        return self._unique('rpaths')
+
+    @property
+    def install_name(self):
+        return self.headers[0].install_name if self.headers else None
+
+def rewrite(path, clear_rpaths=False, add_rpaths=(), edit_libpaths=None,
+            install_name=None):
+    """
+    Apply a set of edits to the load commands of every architecture in a
+    Mach-O file, in place.  The rpaths are cleared (if requested) before
+    the new ones are added, load paths are renamed according to the dict
+    edit_libpaths and, if install_name is given, the LC_ID_DYLIB command is
+    replaced.  All architectures are checked before anything is written,
+    so a MachOError leaves the file untouched.  Returns True if the file
+    was modified.
+    """
+    macho = MachO(path)
+    regions = []
+    for header in macho.headers:
+        try:
+            region = header.edited(clear_rpaths, add_rpaths, edit_libpaths,
+                                   install_name)
+        except MachOError as e:
+            raise MachOError('%s: %s'%(path, e))
+        if region is not None:
+            regions.append((header.offset, region))
+    if not regions:
+        return False
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for offset, region in regions:
+            os.pwrite(fd, region, offset)
+    finally:
+        os.close(fd)
+    return True
@@ -0,0 +1,79 @@
+"""
+The manifest of files to be signed, which replaces the files_to_sign
+list.  It is a JSON lines file with one record per file, giving its path,
+Mach-O file type, architectures and the digest of its unsigned content
+(see macho.MachO.unsigned_digest), so that later stages do not need to
+parse the file again to know what it is.
+
+Records are appended as files are produced, and flushed immediately, so
+the manifest is complete up to the last finished file even if the build
+is interrupted.
+
+Usage: find ... | python3 manifest.py <manifest>
+appends records for the paths read from stdin.
+"""
+
+import sys
+import json
+import threading
+from macho import MachO, MachOError
+
+def manifest_record(path):
+    """
+    Return the manifest record for a file.  Files which are not Mach-O
+    files have type None.
+    """
+    try:
+        macho = MachO(path)
+        return {'path': path, 'type': macho.filetype, 'archs': macho.archs,
+                'hash': macho.unsigned_digest()}
+    except (OSError, MachOError):
+        return {'path': path, 'type': None, 'archs': [], 'hash': None}
+
+class ManifestWriter:
+    def __init__(self, path, mode='a'):
+        self.outfile = open(path, mode)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.outfile.write(line)
+            self.outfile.flush()
+            self.count += 1
+
+    def add(self, path):
+        record = manifest_record(path)
+        self.write(record)
+        return record
+
+    def close(self):
+        self.outfile.close()
+
+def read_manifest(path):
+    """
+    Return the records in a manifest, without repeated paths.  A later
+    record for a path replaces an earlier one.
+    """
+    records = {}
+    with open(path) as infile:
+        for line in infile:
+            if line.strip():
+                record = json.loads(line)
+                records.pop(record['path'], None)
+                records[record['path']] = record
+    return list(records.values())
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    writer = ManifestWriter(sys.argv[1])
+    for line in sys.stdin:
+        if line.strip():
+            writer.add(line.strip())
+    writer.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,217 @@
 """
 Walk through the directory passed as argv[1] and convert each absolute
-symlink into a relative symlink.  Exits with status 1 and prints a warning
-if any symlink is broken or points outside of the top level directory.
+symlink into a relative symlink.  Exits with status 1 and prints a report
+if any symlink is broken or an absolute symlink points outside of the top
+level directory.
+Every symlink is examined before the report is printed, so all of the
+problems are found in one run.  With --check nothing is changed, and the
+absolute symlinks are reported as well.
 
 This needs to be run on the sage directory to remove absolute
 symlinks created when installing packages (mainly GAP packages.)
+
+With --flatten, each chain of symlinks (a link whose target is another
+link, and so on) is also replaced by a single relative link to the end
+of the chain, provided that it stays inside the top level directory.
+Cycles are reported, along with statistics on the chain lengths.
+
+Usage: relativize_links [--check] [--flatten] [--jobs N] [--table FILE] dir
 """
 
 import os
 import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from classify import FileTable, SYMLINK
+
+BROKEN = 'broken'
+FORBIDDEN = 'forbidden'
+ABSOLUTE = 'absolute'
+CYCLE = 'cycle'
+
+def inside(root_dir, path):
+    return path == root_dir or path.startswith(os.path.join(root_dir, ''))
+
+def examine(root_dir, link_path):
+    """
+    Return (kind, link_path, target, new_target), where kind is None for a
+    relative link which needs no attention.  The new target is the
+    relative replacement for an absolute link.
+    """
+    dirpath = os.path.dirname(link_path)
+    target = os.readlink(link_path)
+    if not os.path.exists(os.path.join(dirpath, target)):
+        return BROKEN, link_path, target, None
+    if not os.path.isabs(target):
+        return None, link_path, target, None
+    full_target = os.path.normpath(target)
+    if not inside(root_dir, full_target):
+        return FORBIDDEN, link_path, target, None
+    return ABSOLUTE, link_path, target, os.path.relpath(full_target, dirpath)
+
+def replace_link(link_path, new_target):
+    """
+    Atomically replace a symlink, so that the path always exists.
+    """
+    dirpath, name = os.path.split(link_path)
+    temp = os.path.join(dirpath, '.%s.relink-%d'%(name, os.getpid()))
+    # A run which crashed may have left one behind.
+    try:
+        os.unlink(temp)
+    except FileNotFoundError:
+        pass
+    os.symlink(new_target, temp)
+    os.replace(temp, link_path)
+
+def fix_symlinks(root_dir, check_only=False, table=None, jobs=8):
+    """
+    Examine every symlink below root_dir in parallel, replace the absolute
+    ones unless check_only is set, and return the list of problems as
+    (kind, link_path, target) triples.  In check mode the absolute links
+    are included in the problems.
+    """
+    if table is None:
+        table = FileTable().scan(root_dir)
+    links = table.paths(SYMLINK, under=[root_dir])
+    with ThreadPoolExecutor(jobs) as pool:
+        results = list(pool.map(lambda path: examine(root_dir, path), links))
+    problems = []
+    for kind, link_path, target, new_target in results:
+        if kind is None:
+            continue
+        if kind == ABSOLUTE and not check_only:
+            print('Fixed: %s -> %s'%(link_path, new_target))
+            replace_link(link_path, new_target)
+            continue
+        problems.append((kind, link_path, target))
+    return problems
 
-def fix_symlinks(root_dir, check_only=False):
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for filename in filenames + dirnames:
-            link_path = os.path.join(dirpath, filename)
-            if not os.path.islink(link_path):
-                continue
-            target = os.readlink(link_path)
-            if os.path.isabs(target):
-                if not os.path.exists(target):
-                    print('%s is a broken symlink'%link_path)
-                    if not check_only:
-                        sys.exit(1)
-                    continue
-                if not target.startswith(root_dir):
-                    print('%s has a forbidden target'%link_path)
-                    if not check_only:
-                        sys.exit(1)
-                target_dir, target_base = os.path.split(target)
-                relative_path = os.path.relpath(dirpath, target_dir)
-                new_target = os.path.normpath(
-                    os.path.join(relative_path, target_base))
-                if check_only:
-                    print('Absolute link: %s -> %s\n'%(link_path, target))
-                else:
-                    print('Fixed: %s -> %s'%(link_path, new_target))
-                    os.remove(link_path)
-                    os.symlink(new_target, link_path)
+class LinkCycle(Exception):
+    pass
+
+class ChainResolver:
+    """
+    Follows chains of symlinks, remembering the end of the chain and its
+    length for every link seen, so each link is read only once.  Only the
+    last component of each target is followed; symlinked directories in
+    the middle of a target, such as Versions/Current, are kept.
+    """
+    def __init__(self):
+        self.memo = {}
+        self.active = set()
+
+    def resolve(self, link_path):
+        """
+        Return (end, length) where end is the normalized path at the end
+        of the chain starting with the given link.  Raises LinkCycle.
+        """
+        try:
+            return self.memo[link_path]
+        except KeyError:
+            pass
+        if link_path in self.active:
+            raise LinkCycle(link_path)
+        self.active.add(link_path)
+        try:
+            target = os.path.normpath(os.path.join(
+                os.path.dirname(link_path), os.readlink(link_path)))
+            if os.path.islink(target):
+                end, length = self.resolve(target)
+                result = end, length + 1
             else:
-                full_target = os.path.join(dirpath, target)
-                if not os.path.exists(full_target):
-                    print('%s is a broken symlink'%link_path)
-                    if not check_only:
-                        sys.exit(1)
+                result = target, 1
+        finally:
+            self.active.discard(link_path)
+        self.memo[link_path] = result
+        return result
+
+def flatten_symlinks(root_dir, check_only=False, table=None):
+    """
+    Replace each chain of symlinks below root_dir by a single relative
+    link, unless check_only is set.  Return the list of problems, as
+    (kind, link_path, target) triples, and a dict mapping chain lengths
+    to the number of links with that length.
+    """
+    if table is None:
+        table = FileTable().scan(root_dir)
+    resolver = ChainResolver()
+    problems, lengths = [], {}
+    for link_path in table.paths(SYMLINK, under=[root_dir]):
+        target = os.readlink(link_path)
+        try:
+            end, length = resolver.resolve(link_path)
+        except LinkCycle:
+            problems.append((CYCLE, link_path, target))
+            continue
+        lengths[length] = lengths.get(length, 0) + 1
+        if length == 1 or check_only:
+            continue
+        if not os.path.exists(end) or not inside(root_dir, end):
+            continue
+        dirpath = os.path.dirname(link_path)
+        new_target = os.path.relpath(end, dirpath)
+        # A '..' after a symlinked directory may defeat the normalization.
+        if (os.path.realpath(os.path.join(dirpath, new_target)) !=
+                os.path.realpath(link_path)):
+            continue
+        print('Flattened: %s -> %s (was %d hops)'%(
+            link_path, new_target, length))
+        replace_link(link_path, new_target)
+    return problems, lengths
+
+def chain_statistics(lengths):
+    total = sum(lengths.values())
+    if not total:
+        return 'No symlinks found'
+    lines = ['%d symlinks, longest chain %d, mean length %.2f'%(
+        total, max(lengths),
+        sum(k*v for k, v in lengths.items())/total)]
+    lines += ['%6d chains of length %d'%(lengths[k], k)
+              for k in sorted(lengths)]
+    return '\n'.join(lines)
+
+def report(problems):
+    lines = []
+    for kind, description in ((BROKEN, 'is a broken symlink'),
+                              (FORBIDDEN, 'has a forbidden target'),
+                              (CYCLE, 'is part of a cycle'),
+                              (ABSOLUTE, 'is an absolute symlink')):
+        lines += ['%s %s: %s'%(link_path, description, target)
+                  for found, link_path, target in problems if found == kind]
+    return '\n'.join(lines)
 
 def main():
-    try:
-        root_dir = os.path.abspath(sys.argv[1])
-    except IndexError:
-        print('Usage: relativize_links dir')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description='Convert the absolute symlinks in a directory into '
+        'relative symlinks.')
+    parser.add_argument('dir')
+    parser.add_argument('--check', action='store_true',
+                        help='only report problems and absolute symlinks')
+    parser.add_argument('--flatten', action='store_true',
+                        help='replace chains of symlinks by single links')
+    parser.add_argument('--jobs', '-j', type=int, default=8,
+                        help='number of worker threads')
+    parser.add_argument('--table',
+                        help='file classification cache, shared with '
+                        'fix_paths and fix_scripts')
+    args = parser.parse_args()
+    root_dir = os.path.abspath(args.dir)
     if not os.path.isdir(root_dir):
         print('%s is not a directory'%root_dir)
         sys.exit(1)
-    fix_symlinks(root_dir, check_only=False)
+    table = FileTable(args.table).scan(root_dir)
+    problems = fix_symlinks(root_dir, args.check, table, args.jobs)
+    if args.flatten:
+        cycles, lengths = flatten_symlinks(root_dir, args.check, table)
+        # Links in a cycle also appear to be broken.
+        in_cycle = set(link_path for _, link_path, _ in cycles)
+        problems = [p for p in problems if p[1] not in in_cycle] + cycles
+        print(chain_statistics(lengths))
+    if args.table:
+        table.save()
+    if problems:
+        print(report(problems))
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
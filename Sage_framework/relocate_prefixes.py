@@ -0,0 +1,276 @@
+"""
+Replace build prefixes throughout a framework.
+
+Every regular file is scanned, through mmap, for all of the given build
+prefixes at once with a single compiled alternation, and only files
+containing a hit are rewritten:
+
+  * Mach-O files are edited in place.  Only the __TEXT,__cstring and
+    __TEXT,__const sections of each architecture are scanned, and each
+    NUL terminated string there containing a prefix is rewritten with
+    the replacement and padded with NUL bytes, so nothing moves.  A
+    replacement longer than its prefix cannot be made this way, and is
+    reported instead.  Code, data and the load commands, which are left
+    to fix_paths, are never touched.
+  * Text files are rewritten by streaming them through the matcher into
+    a temporary file, which then replaces the original, keeping its mode.
+  * Other binary files are reported but not changed, since their
+    contents may depend on the length of the strings.
+
+The throughput of the scan is reported.  With --check nothing is changed,
+the files containing a prefix are listed and the exit status is 1 if
+there are any.
+
+Usage: python3 relocate_prefixes.py --prefix OLD=NEW [--prefix ...]
+           [--check] [--jobs N] [--table FILE] directory ...
+"""
+
+import os
+import re
+import sys
+import mmap
+import stat
+import time
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from macho import MachO, MachOError
+from classify import FileTable, MACHO, SCRIPT, CONFIG, OTHER
+
+# Bytes read to decide whether a file is text.
+TEXT_PROBE = 8192
+CHUNK = 1 << 20
+# The sections of Mach-O files whose strings are relocated.
+SECTIONS = (('__TEXT', '__cstring'), ('__TEXT', '__const'))
+
+CLEAN = 'clean'
+TEXT = 'text'
+BINARY = 'binary'
+TOO_LONG = 'too long'
+
+class PrefixMatcher:
+    """
+    Finds and replaces any of a set of prefixes, given as a dict mapping
+    each prefix to its replacement (both bytes).
+    """
+    def __init__(self, mapping):
+        self.mapping = dict(mapping)
+        # Longer prefixes first, so that the longest match wins.
+        prefixes = sorted(self.mapping, key=len, reverse=True)
+        self.pattern = re.compile(b'|'.join(re.escape(p) for p in prefixes))
+        # A match can start in the last keep bytes of a chunk and end in
+        # the next one.
+        self.keep = len(prefixes[0]) - 1
+
+    def replacement(self, match):
+        return self.mapping[match.group()]
+
+    def contains(self, data, ranges=None):
+        """
+        Return True if a prefix occurs in data or, if a list of (start,
+        end) ranges is given, in one of them.
+        """
+        if ranges is None:
+            return self.pattern.search(data) is not None
+        return any(self.pattern.search(data, start, end) is not None
+                   for start, end in ranges)
+
+    def replace_stream(self, infile, outfile):
+        """
+        Copy infile to outfile, replacing the prefixes, and return the
+        number of replacements.
+        """
+        count = 0
+        buffer = b''
+        while True:
+            chunk = infile.read(CHUNK)
+            buffer += chunk
+            limit = len(buffer) - self.keep if chunk else len(buffer)
+            position = 0
+            for match in self.pattern.finditer(buffer):
+                if match.start() >= limit:
+                    break
+                outfile.write(buffer[position:match.start()])
+                outfile.write(self.replacement(match))
+                position = match.end()
+                count += 1
+            if not chunk:
+                outfile.write(buffer[position:])
+                return count
+            end = max(position, limit)
+            outfile.write(buffer[position:end])
+            buffer = buffer[end:]
+
+    def replace_cstrings(self, data, ranges):
+        """
+        Replace the prefixes in the NUL terminated strings which lie in
+        the given (start, end) ranges of a writable buffer, without
+        changing its length.  A match which is not followed by a NUL in
+        its range is left alone.  Return the number of replacements and
+        the number which did not fit.
+        """
+        count = too_long = 0
+        for range_start, range_end in ranges:
+            done = range_start
+            for match in self.pattern.finditer(data, range_start, range_end):
+                start = match.start()
+                if start < done:
+                    continue
+                end = data.find(b'\0', start, range_end)
+                if end < 0:
+                    break
+                done = end
+                n, fits = self._replace_cstring(data, start, end)
+                count += n if fits else 0
+                too_long += 0 if fits else n
+        return count, too_long
+
+    def _replace_cstring(self, data, start, end):
+        """
+        Replace the prefixes in data[start:end], padding with NUL bytes.
+        Return the number of prefixes and whether the replacement fits.
+        """
+        old = data[start:end]
+        new, n = self.pattern.subn(self.replacement, old)
+        if len(new) > len(old):
+            return n, False
+        data[start:end] = new + bytes(len(old) - len(new))
+        return n, True
+
+def cstring_ranges(path):
+    """
+    The file offsets of the C string sections of each slice.
+    """
+    ranges = []
+    try:
+        headers = MachO(path).headers
+    except MachOError:
+        return ranges
+    for header in headers:
+        for segname, sectname, offset, size, flags in header.sections():
+            if (segname, sectname) in SECTIONS and offset and size:
+                start = header.offset + offset
+                ranges.append((start, start + size))
+    return ranges
+
+def rewrite_text(matcher, path):
+    dirname, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(prefix='.%s.'%name, dir=dirname)
+    try:
+        with open(path, 'rb') as infile, open(fd, 'wb') as outfile:
+            count = matcher.replace_stream(infile, outfile)
+            mode = stat.S_IMODE(os.fstat(infile.fileno()).st_mode)
+            os.fchmod(outfile.fileno(), mode)
+    except BaseException:
+        os.unlink(temp)
+        raise
+    os.replace(temp, path)
+    return count
+
+def relocate_file(matcher, path, kind, check_only=False):
+    """
+    Scan one file and rewrite it if it contains a prefix.  Return
+    (path, action, replacements, size), where action is CLEAN, TEXT,
+    MACHO, BINARY or TOO_LONG.
+    """
+    try:
+        size = os.path.getsize(path)
+        if not size:
+            return path, CLEAN, 0, 0
+        ranges = cstring_ranges(path) if kind == MACHO else None
+        with open(path, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                if not matcher.contains(data, ranges):
+                    return path, CLEAN, 0, size
+                is_text = b'\0' not in data[:TEXT_PROBE]
+    except (OSError, ValueError) as e:
+        print('Skipping %s: %s'%(path, e), file=sys.stderr)
+        return path, CLEAN, 0, 0
+    if kind == MACHO:
+        if check_only:
+            return path, MACHO, 0, size
+        with open(path, 'r+b') as infile:
+            with mmap.mmap(infile.fileno(), 0) as data:
+                count, too_long = matcher.replace_cstrings(data, ranges)
+                data.flush()
+        return path, TOO_LONG if too_long else MACHO, count, size
+    if kind in (SCRIPT, CONFIG) or is_text:
+        if check_only:
+            return path, TEXT, 0, size
+        return path, TEXT, rewrite_text(matcher, path), size
+    return path, BINARY, 0, size
+
+def relocate(directories, mapping, jobs=1, table=None, check_only=False):
+    """
+    Relocate every regular file below the given directories.  Return the
+    list of (path, action, replacements, size) for all of them.
+    """
+    if table is None:
+        table = FileTable().scan(*directories)
+    matcher = PrefixMatcher(mapping)
+    kinds = dict((path, table.entries[path].kind) for path in
+                 table.paths(MACHO, SCRIPT, CONFIG, OTHER,
+                             under=directories))
+    paths = list(kinds)
+    args = ([matcher]*len(paths), paths, [kinds[p] for p in paths],
+            [check_only]*len(paths))
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(relocate_file, *args, chunksize=64))
+    return list(map(relocate_file, *args))
+
+def report(results, elapsed, check_only=False):
+    scanned = sum(size for _, _, _, size in results)
+    lines = ['Scanned %d files (%.2f GB) in %.2fs: %.2f GB/s'%(
+        len(results), scanned/1e9, elapsed, scanned/1e9/max(elapsed, 1e-9))]
+    if check_only:
+        lines += ['%s contains a prefix'%r[0] for r in results
+                  if r[1] in (TEXT, MACHO)]
+    for action, description in ((TEXT, 'text files rewritten'),
+                                 (MACHO, 'Mach-O files edited in place')):
+        found = [r for r in results if r[1] == action]
+        if found and not check_only:
+            lines.append('%6d %s (%d replacements)'%(
+                len(found), description, sum(r[2] for r in found)))
+    for action, description in (
+            (TOO_LONG, 'has a prefix whose replacement is too long'),
+            (BINARY, 'is a binary file containing a prefix')):
+        lines += ['%s %s'%(r[0], description)
+                  for r in results if r[1] == action]
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replace build prefixes in all of the files below '
+        'the given directories.')
+    parser.add_argument('directories', nargs='+', metavar='directory')
+    parser.add_argument('--prefix', action='append', required=True,
+                        metavar='OLD=NEW', help='a prefix and its '
+                        'replacement; may be given more than once')
+    parser.add_argument('--check', action='store_true',
+                        help='only report the files which contain a prefix')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--table',
+                        help='file classification cache, shared with '
+                        'fix_paths and fix_scripts')
+    args = parser.parse_args()
+    mapping = {}
+    for item in args.prefix:
+        old, sep, new = item.partition('=')
+        if not sep or not old:
+            parser.error('bad --prefix %s'%item)
+        mapping[os.fsencode(old)] = os.fsencode(new)
+    directories = [os.path.abspath(d) for d in args.directories]
+    table = FileTable(args.table).scan(*directories)
+    start = time.perf_counter()
+    results = relocate(directories, mapping, args.jobs, table, args.check)
+    print(report(results, time.perf_counter() - start, args.check))
+    if args.table:
+        table.save()
+    if args.check and any(r[1] != CLEAN for r in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+A persistent record of the Mach-O files which have been fixed by
+fix_paths, so that a rerun can skip files which are already relocated.
+
+Each entry is keyed by path and records the size, mtime and load command
+digest of the file after it was fixed, together with the rpaths and load
+path edits which were applied and the time that took.  A file whose size
+and mtime are unchanged is skipped after a single stat.  A file which has
+been touched is skipped if its load commands still have the recorded
+digest.  The digest leaves out the code signature (see
+macho.MachO.commands_digest), so signing a fixed file does not make it
+look unfixed.
+"""
+
+import os
+import json
+
+class RelocationCache:
+    def __init__(self, path, local_lib, force=False):
+        self.path = path
+        self.local_lib = local_lib
+        self.force = force
+        self.entries = {}
+        self.hits = self.misses = 0
+        self.time_saved = 0.0
+        try:
+            with open(path) as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return
+        # Entries recorded for a different Sage version are useless.
+        if data.get('local_lib') == local_lib:
+            self.entries = data.get('files', {})
+
+    def lookup(self, path):
+        """
+        Return (hit, digest).  A hit means that the file has the recorded
+        size and mtime.  Otherwise digest is the recorded load command
+        digest, if any, for the worker to compare with the file.
+        """
+        entry = None if self.force else self.entries.get(path)
+        if entry is None:
+            return False, None
+        st = os.stat(path)
+        if st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime']:
+            return True, entry['digest']
+        return False, entry['digest']
+
+    def hit(self, path):
+        self.hits += 1
+        entry = self.entries[path]
+        self.time_saved += entry['seconds']
+        # Record the current stat, so the next lookup is a stat hit.
+        st = os.stat(path)
+        entry['size'], entry['mtime'] = st.st_size, st.st_mtime_ns
+
+    def miss(self, path, entry):
+        self.misses += 1
+        self.entries[path] = entry
+
+    def save(self):
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as outfile:
+            json.dump({'local_lib': self.local_lib, 'files': self.entries},
+                      outfile)
+        os.replace(temp, self.path)
+
+    def summary(self):
+        return ('Relocation cache: %d hits, %d misses, %.1fs saved'%(
+            self.hits, self.misses, self.time_saved))
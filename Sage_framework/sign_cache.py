@@ -0,0 +1,87 @@
+"""
+A persistent record of the Mach-O files which have been signed by
+sign_sage, so that a rerun can skip files which are already signed.
+
+Each entry is keyed by path and records a digest of the file's unsigned
+content, which is the same before and after codesign, a digest of the
+signature which codesign wrote, and the identity and entitlements which
+were used.  A file is skipped if its unsigned content, its signature and
+the signing parameters all match the entry.  If the file was rebuilt, or
+was signed again by something else, or the identity or entitlements have
+changed, it is signed again.
+"""
+
+import os
+import json
+import hashlib
+from macho import MachO, MachOError
+
+def file_digest(path):
+    with open(path, 'rb') as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+class SignCache:
+    def __init__(self, path, identity, entitlements, force=False):
+        self.path = path
+        self.identity = identity
+        self.entitlements = file_digest(entitlements)
+        self.force = force
+        self.entries = {}
+        self.hits = self.misses = 0
+        self.time_saved = 0.0
+        try:
+            with open(path) as infile:
+                self.entries = json.load(infile).get('files', {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def digests(path):
+        """
+        Return the unsigned content and signature digests of a file, or
+        (None, None) if it is not a Mach-O file.
+        """
+        try:
+            macho = MachO(path)
+            return macho.unsigned_digest(), macho.signature_digest()
+        except (OSError, MachOError):
+            return None, None
+
+    def lookup(self, path):
+        """
+        Return True if the file is signed exactly as recorded.
+        """
+        entry = None if self.force else self.entries.get(path)
+        if (entry is None or entry['identity'] != self.identity or
+                entry['entitlements'] != self.entitlements):
+            return False
+        content, signature = self.digests(path)
+        return (signature is not None and content == entry['content'] and
+                signature == entry['signature'])
+
+    def hit(self, path):
+        self.hits += 1
+        self.time_saved += self.entries[path]['seconds']
+
+    def record(self, path, seconds, content, signature):
+        """
+        Record the digests of a file which has just been signed.
+        """
+        self.misses += 1
+        if signature is None:
+            self.entries.pop(path, None)
+            return
+        self.entries[path] = {'content': content, 'signature': signature,
+                              'identity': self.identity,
+                              'entitlements': self.entitlements,
+                              'seconds': seconds}
+
+    def save(self):
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as outfile:
+            json.dump({'files': self.entries}, outfile)
+        os.replace(temp, self.path)
+
+    def summary(self):
+        return ('Signing cache: %d hits, %d misses, %.1fs saved'%(
+            self.hits, self.misses, self.time_saved))
@@ -1,30 +1,196 @@
-import subprocess
+"""
+Sign the files listed in the manifest written by fix_paths (see
+manifest.py), and then the framework.
+
+Signing is scheduled by nesting level: every path is signed only after
+all of the signed paths which it contains, so leaf code comes first and
+each enclosing bundle or framework comes after its contents.  The paths
+in each level are signed by a bounded pool of workers, failures which
+look transient (e.g. an unavailable timestamp server) are retried, and
+the timing and result for each path are written to a log.
+
+Files which are already signed with the same identity and entitlements,
+and whose unsigned content has not changed, are skipped; see sign_cache.
+Containers are always signed, since their signatures seal resources.
+With fix_paths --sign, each Mach-O file is signed by a SigningQueue as
+soon as it has been relocated and stripped, so here those files are
+cache hits unless something has changed them since.
+
+Usage: python3 sign_sage.py [framework] [--jobs N] [--log FILE]
+           [--cache FILE] [--force] [--manifest FILE]
+With "framework" only the framework itself is signed.
+"""
+
 import os
 import sys
-DEV_ID = os.environ['DEV_ID']
+import re
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from sign_cache import SignCache
+from manifest import read_manifest
+from tools import TOOLS
 entitlement_file = 'entitlement.plist'
+framework = 'build/Sage.framework'
+manifest_file = 'files_to_sign.jsonl'
 framework_path = os.path.abspath('build/Sage.framework/Versions/Current')
 extra_files = []
-file_args = ['codesign', '-v', '-s', DEV_ID, '--timestamp', '--options',
-    'runtime', '--force', '--entitlements', entitlement_file]
-
-if len(sys.argv) == 1 or sys.argv[1] != 'framework':
-    with open('files_to_sign') as infile:
-        for path in infile.readlines():
-            signee = path.strip()
-            result = subprocess.run(file_args + [signee], capture_output=True)
-            if result.returncode:
-                print('Failed on %s'%path)
-                print(result.stderr)
-
-    for path in extra_files:
-        signee = os.path.join(framework_path, path)
-        result = subprocess.run(file_args + [signee], capture_output=True)
+transient = re.compile(
+    rb'timestamp service is not available|timed out|network connection|'
+    rb'resource temporarily unavailable', re.IGNORECASE)
+
+def file_args(dev_id):
+    # The arguments for codesign, which is run through the tools backend.
+    return ['-v', '-s', dev_id, '--timestamp', '--options', 'runtime',
+            '--force', '--entitlements', entitlement_file]
+
+def nesting_levels(paths):
+    """
+    Return a list of lists of paths.  A path is in a later level than
+    every other path which it contains, so signing the levels in order
+    never signs a container before its contents.
+    """
+    normalized = dict((path, os.path.abspath(path)) for path in paths)
+    containers = [path for path in paths if os.path.isdir(path)]
+    height = dict((path, 0) for path in paths)
+    # Innermost containers first, so each container sees final heights.
+    containers.sort(key=lambda path: -normalized[path].count(os.path.sep))
+    for container in containers:
+        prefix = os.path.join(normalized[container], '')
+        inner = [height[path] for path in paths
+                 if normalized[path].startswith(prefix)]
+        height[container] = 1 + max(inner, default=-1)
+    levels = [[] for n in range(max(height.values(), default=-1) + 1)]
+    for path in paths:
+        levels[height[path]].append(path)
+    return levels
+
+class Signer:
+    def __init__(self, args, jobs=None, retries=3, log_path=None,
+                 cache=None, tools=TOOLS):
+        self.args = args
+        self.tools = tools
+        self.cache = cache
+        self.jobs = jobs or os.cpu_count()
+        self.retries = retries
+        self.log_path = log_path
+        self.records = []
+        self.failed = []
+
+    def sign_one(self, path, level):
+        start = time.perf_counter()
+        if self.cache and self.cache.lookup(path):
+            return {'path': path, 'level': level, 'returncode': 0,
+                    'attempts': 0, 'cached': True,
+                    'seconds': round(time.perf_counter() - start, 3)}
+        for attempt in range(1, self.retries + 2):
+            result = self.tools.run('codesign', self.args + [path], [path])
+            if not result.returncode or not transient.search(result.stderr):
+                break
+            if attempt <= self.retries:
+                time.sleep(2**attempt)
+        record = {'path': path, 'level': level,
+                  'returncode': result.returncode, 'attempts': attempt,
+                  'seconds': round(time.perf_counter() - start, 3)}
         if result.returncode:
-            print('Failed on %s'%path)
-            print(result.stderr)
-            
-print('Signing framework ...')
-subprocess.run(file_args + ['build/Sage.framework'])
+            record['stderr'] = result.stderr.decode('utf-8', 'replace')
+        elif self.cache and not os.path.isdir(path):
+            record['content'], record['signature'] = SignCache.digests(path)
+        return record
+
+    def collect(self, records):
+        for record in records:
+            if record['returncode']:
+                print('Failed on %s'%record['path'])
+                print(record['stderr'])
+                self.failed.append(record['path'])
+            elif record.get('cached'):
+                self.cache.hit(record['path'])
+            elif 'signature' in record:
+                self.cache.record(record['path'], record['seconds'],
+                                  record['content'], record['signature'])
+        self.records += records
+
+    def finish(self):
+        """
+        Save the cache and write the log.  Return the number of failures.
+        """
+        if self.cache:
+            self.cache.save()
+            print(self.cache.summary())
+        if self.log_path:
+            with open(self.log_path, 'w') as outfile:
+                for record in self.records:
+                    outfile.write(json.dumps(record) + '\n')
+        return len(self.failed)
+
+    def sign(self, paths):
+        """
+        Sign the paths level by level.  Return the number of failures.
+        """
+        for level, group in enumerate(nesting_levels(paths)):
+            with ThreadPoolExecutor(self.jobs) as pool:
+                self.collect(list(pool.map(
+                    lambda path: self.sign_one(path, level), group)))
+        return self.finish()
+
+class SigningQueue:
+    """
+    Signs files as soon as they are produced, e.g. by fix_paths, so that
+    signing overlaps with the work of the producer.  The files must be
+    leaves, such as Mach-O files, since no nesting order is imposed.  Call
+    put for each file and then close, which waits for all of the queued
+    files and returns the number of failures.
+    """
+    def __init__(self, signer):
+        self.signer = signer
+        self.pool = ThreadPoolExecutor(signer.jobs)
+        self.futures = []
+
+    def put(self, path):
+        self.futures.append(self.pool.submit(self.signer.sign_one, path, 0))
+
+    def close(self):
+        self.pool.shutdown()
+        self.signer.collect([future.result() for future in self.futures])
+        return self.signer.finish()
 
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sign the files in the manifest and the framework.')
+    parser.add_argument('mode', nargs='?', choices=['framework'])
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of concurrent codesign processes')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries after a transient failure')
+    parser.add_argument('--log', default='sign_log.jsonl',
+                        help='per file timing and result log '
+                        '(default: %(default)s)')
+    parser.add_argument('--cache', default='sign_cache.json',
+                        help='record of signed files (default: %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='sign every file, ignoring the cache')
+    parser.add_argument('--manifest', default=manifest_file,
+                        help='the files to sign (default: %(default)s)')
+    args = parser.parse_args()
+    dev_id = os.environ['DEV_ID']
+    cache = SignCache(args.cache, dev_id, entitlement_file, args.force)
+    signer = Signer(file_args(dev_id), args.jobs, args.retries, args.log,
+                    cache)
+    paths = []
+    if args.mode != 'framework':
+        paths = [record['path'] for record in read_manifest(args.manifest)]
+        paths += [os.path.join(framework_path, path) for path in extra_files]
+        print('Signing files ...')
+    else:
+        print('Signing framework ...')
+    # The framework is the outermost container, so it is signed last.
+    failures = signer.sign(list(dict.fromkeys(paths + [framework])))
+    print(signer.tools.summary())
+    if failures:
+        print('%d signatures failed'%failures)
+        sys.exit(1)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Strip local symbols from Mach-O files as a separate stage of fix_paths.
+
+Files which have no local symbols are skipped.  The remaining files are
+passed to the strip tool in large batches which run in parallel, and the
+number of bytes saved is reported for each directory.  The tool is
+configurable, and is run through the tools backend, so that a stand-in
+can be used when timing or testing on a system without Apple's strip.
+"""
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from macho import MachO, MachOError
+from tools import TOOLS
+
+# Stripping more than this breaks the gcc stub library, but probably most
+# executables and libraries could be stripped to -u -r without causing
+# problems.
+STRIP_TOOL = ('strip', '-x')
+# Limits on the size of the argument list for one run of the tool.
+BATCH_FILES = 500
+BATCH_CHARS = 100000
+
+def needs_strip(path):
+    try:
+        return MachO(path).has_local_symbols()
+    except MachOError:
+        return False
+
+def batches(paths):
+    batch, chars = [], 0
+    for path in paths:
+        if batch and (len(batch) >= BATCH_FILES or
+                      chars + len(path) > BATCH_CHARS):
+            yield batch
+            batch, chars = [], 0
+        batch.append(path)
+        chars += len(path) + 1
+    if batch:
+        yield batch
+
+def run_batch(tools, tool, batch):
+    result = tools.run('strip', batch, batch, default=tool)
+    if result.returncode:
+        print('%s failed on a batch of %d files:'%(tool[0], len(batch)),
+              file=sys.stderr)
+        print(result.stderr.decode('utf-8', 'replace'), file=sys.stderr)
+    return result.returncode
+
+class StripStage:
+    def __init__(self, tool=STRIP_TOOL, jobs=1, tools=TOOLS):
+        self.tool = tuple(tool)
+        self.tools = tools
+        self.jobs = jobs
+        self.stripped = []
+        self.skipped = 0
+        self.saved = {}
+
+    def run(self, paths):
+        """
+        Strip the given files, and return the list of files which were
+        passed to the strip tool.
+        """
+        todo = [path for path in paths if needs_strip(path)]
+        self.skipped += len(paths) - len(todo)
+        sizes = dict((path, os.path.getsize(path)) for path in todo)
+        with ThreadPoolExecutor(max(1, self.jobs)) as pool:
+            list(pool.map(lambda batch: run_batch(self.tools, self.tool,
+                                                  batch),
+                          batches(todo)))
+        for path in todo:
+            directory = os.path.dirname(path)
+            saved = sizes[path] - os.path.getsize(path)
+            self.saved[directory] = self.saved.get(directory, 0) + saved
+        self.stripped += todo
+        return todo
+
+    def report(self):
+        lines = ['Stripped %d files, skipped %d already stripped files'%(
+            len(self.stripped), self.skipped)]
+        for directory in sorted(self.saved):
+            lines.append('%10d bytes saved in %s'%(
+                self.saved[directory], directory))
+        return '\n'.join(lines)
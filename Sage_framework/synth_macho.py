@@ -0,0 +1,234 @@
+"""
+Generate synthetic Mach-O files and a synthetic Sage tree, so that the
+relocation tools can be exercised and timed on a system without a real
+macOS build of Sage.
+
+The files are minimal but valid: a 64 bit header, a __TEXT segment with
+__text and __cstring sections, a __LINKEDIT segment holding a symbol
+table, and any number of LC_ID_DYLIB, LC_LOAD_DYLIB and LC_RPATH
+commands followed by a configurable amount of header padding.  Fat files
+contain one such slice per architecture.
+
+Usage: python3 synth_macho.py [--libs N] [--deps N] [--rpaths N]
+           [--padding BYTES] [--fat-every N] [--seed N] <directory>
+"""
+
+import os
+import sys
+import random
+import struct
+import argparse
+from macho import (FILETYPES, LC_SEGMENT_64, LC_SYMTAB, LC_DYSYMTAB,
+    LC_ID_DYLIB, LC_LOAD_DYLIB, LC_RPATH, LC_CODE_SIGNATURE)
+
+CPU_X86_64 = 0x01000007
+CPU_ARM64 = 0x0100000c
+FILETYPE_CODES = dict((name, code) for code, name in FILETYPES.items())
+PREFIX = '/var/tmp/sage-X.X-current'
+PYTHON = 'python3.11'
+VENV_LIB = 'local/var/lib/sage/venv-%s/lib/%s'%(PYTHON, PYTHON)
+
+def align(n, alignment):
+    return (n + alignment - 1) & ~(alignment - 1)
+
+def lc_str_command(cmd, string, fixed=b''):
+    """Build a load command with a single lc_str, aligned to 8 bytes."""
+    offset = 12 + len(fixed)
+    encoded = string.encode('utf-8')
+    size = align(offset + len(encoded) + 1, 8)
+    data = struct.pack('<3I', cmd, size, offset) + fixed + encoded
+    return data + b'\0'*(size - len(data))
+
+def thin_macho(cputype, filetype, dylibs=(), rpaths=(), install_name=None,
+               padding=1024, text_size=4096, cstrings=(), local_symbols=8,
+               global_symbols=4, signature_size=0):
+    """
+    Return the bytes of a 64 bit Mach-O file.  If signature_size is
+    nonzero a dummy code signature of that size is appended.
+    """
+    dylib_fixed = struct.pack('<3I', 2, 0x10000, 0x10000)
+    commands = []
+    if install_name:
+        commands.append(lc_str_command(LC_ID_DYLIB, install_name,
+                                       dylib_fixed))
+    commands += [lc_str_command(LC_LOAD_DYLIB, dylib, dylib_fixed)
+                 for dylib in dylibs]
+    commands += [lc_str_command(LC_RPATH, rpath) for rpath in rpaths]
+    fixed_size = (72 + 2*80) + 72 + 24 + 80
+    sizeofcmds = fixed_size + sum(len(c) for c in commands)
+    # As with codesign, LC_CODE_SIGNATURE takes space from the padding, so
+    # the layout is the same with or without a signature.
+    text_offset = align(32 + sizeofcmds + padding, 16)
+    if signature_size:
+        sizeofcmds += 16
+    cstring = b''.join(s.encode('utf-8') + b'\0' for s in cstrings)
+    cstring_offset = text_offset + text_size
+    text_end = align(cstring_offset + len(cstring), 16)
+    # The symbol table, with the local symbols first, and the string table.
+    nsyms = local_symbols + global_symbols
+    names = [b'_local%d'%n for n in range(local_symbols)]
+    names += [b'_global%d'%n for n in range(global_symbols)]
+    strtab, symtab = b'\0', []
+    for n, name in enumerate(names):
+        n_type = 0x0e if n < local_symbols else 0x0f
+        symtab.append(struct.pack('<IBBHQ', len(strtab), n_type, 1, 0,
+                                  text_offset + n))
+        strtab += name + b'\0'
+    strtab += b'\0'*(align(len(strtab), 8) - len(strtab))
+    symoff = text_end
+    stroff = symoff + 16*nsyms
+    linkedit_end = stroff + len(strtab)
+    signature_offset = align(linkedit_end, 16)
+    file_size = signature_offset + signature_size if signature_size else linkedit_end
+    text_segment = struct.pack('<2I16s4Q4I', LC_SEGMENT_64, 72 + 2*80,
+        b'__TEXT', 0, text_end, 0, text_end, 5, 5, 2, 0)
+    text_section = struct.pack('<16s16s2Q8I', b'__text', b'__TEXT',
+        text_offset, text_size, text_offset, 4, 0, 0, 0x80000400, 0, 0, 0)
+    cstring_section = struct.pack('<16s16s2Q8I', b'__cstring', b'__TEXT',
+        cstring_offset, len(cstring), cstring_offset, 0, 0, 0, 0x2, 0, 0, 0)
+    linkedit_segment = struct.pack('<2I16s4Q4I', LC_SEGMENT_64, 72,
+        b'__LINKEDIT', align(text_end, 0x4000), file_size - text_end,
+        text_end, file_size - text_end, 1, 1, 0, 0)
+    symtab_command = struct.pack('<6I', LC_SYMTAB, 24, symoff, nsyms,
+                                 stroff, len(strtab))
+    dysymtab_command = struct.pack('<20I', LC_DYSYMTAB, 80, 0,
+        local_symbols, local_symbols, global_symbols, nsyms, 0, *[0]*12)
+    commands = [text_segment + text_section + cstring_section,
+                linkedit_segment] + commands + [symtab_command,
+                dysymtab_command]
+    if signature_size:
+        commands.append(struct.pack('<4I', LC_CODE_SIGNATURE, 16,
+                                    signature_offset, signature_size))
+    header = struct.pack('<8I', 0xfeedfacf, cputype, 3,
+                         FILETYPE_CODES[filetype], len(commands),
+                         sizeofcmds, 0x85, 0)
+    data = header + b''.join(commands)
+    data += b'\0'*(text_offset - len(data))
+    data += b'\x90'*text_size + cstring
+    data += b'\0'*(symoff - len(data))
+    data += b''.join(symtab) + strtab
+    if signature_size:
+        data += b'\0'*(signature_offset - len(data))
+        blob = struct.pack('>3I', 0xfade0cc0, signature_size, 0)
+        data += blob + b'\xa5'*(signature_size - len(blob))
+    return data
+
+def fat_macho(slices, align_bits=14):
+    """
+    Return the bytes of a fat file containing the given (cputype, data)
+    slices.
+    """
+    alignment = 1 << align_bits
+    header = struct.pack('>2I', 0xcafebabe, len(slices))
+    offset = alignment
+    table, body = [], []
+    for cputype, data in slices:
+        table.append(struct.pack('>5I', cputype, 0, offset, len(data),
+                                 align_bits))
+        padded = align(len(data), alignment)
+        body.append(data + b'\0'*(padded - len(data)))
+        offset += padded
+    start = header + b''.join(table)
+    return start + b'\0'*(alignment - len(start)) + b''.join(body)
+
+def macho_file(path, filetype, fat=False, **kwargs):
+    """
+    Write a thin arm64 file, or a fat x86_64/arm64 file, and return its
+    size.
+    """
+    if fat:
+        data = fat_macho([(cputype, thin_macho(cputype, filetype, **kwargs))
+                          for cputype in (CPU_X86_64, CPU_ARM64)])
+    else:
+        data = thin_macho(CPU_ARM64, filetype, **kwargs)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as outfile:
+        outfile.write(data)
+    return len(data)
+
+def make_tree(root, libs=200, deps=4, rpaths=2, padding=1024, fat_every=3,
+              seed=0, prefix=PREFIX):
+    """
+    Create a synthetic Sage tree below root, laid out like the local
+    directory of the framework: versioned dylibs with unversioned
+    symlinks in local/lib and a few of its subdirectories, executables
+    and scripts in local/bin, pkg-config files, and extension modules in
+    the venv.  Load paths and rpaths refer to the build prefix, as they
+    do after a real build.  Return a dict of counts.
+    """
+    rng = random.Random(seed)
+    build_rpaths = [os.path.join(prefix, 'local', 'lib'),
+                    os.path.join(prefix, 'local', 'lib', 'gcc'),
+                    os.path.join(prefix, 'local', 'var', 'tmp', 'build')]
+    counts = dict(macho=0, bytes=0, symlinks=0, scripts=0, configs=0)
+    installed = []
+    def options(n):
+        chosen = rng.sample(installed, min(deps, len(installed)))
+        return dict(dylibs=chosen + ['/usr/lib/libSystem.B.dylib'],
+                    rpaths=build_rpaths[:rpaths], padding=padding,
+                    cstrings=['synthetic %d'%n,
+                              os.path.join(prefix, 'local', 'share')])
+    for n in range(libs):
+        subdir = ('local/lib/R/lib' if n % 20 == 19 else
+                  'local/lib/gcc' if n % 20 == 18 else 'local/lib')
+        name = 'libsynth%d.1.dylib'%n
+        install_name = os.path.join(prefix, subdir, name)
+        path = os.path.join(root, subdir, name)
+        counts['bytes'] += macho_file(path, 'MH_DYLIB',
+            fat=(fat_every and n % fat_every == 0),
+            install_name=install_name, **options(n))
+        os.symlink(name, os.path.join(root, subdir, 'libsynth%d.dylib'%n))
+        installed.append(install_name)
+        counts['macho'] += 1
+        counts['symlinks'] += 1
+        if n % 10 == 0:
+            pc = os.path.join(root, 'local/lib/pkgconfig', 'synth%d.pc'%n)
+            os.makedirs(os.path.dirname(pc), exist_ok=True)
+            with open(pc, 'w') as outfile:
+                outfile.write('prefix=%s/local\nlibdir=${prefix}/lib\n'
+                              'Libs: -L${libdir} -lsynth%d\n'%(prefix, n))
+            counts['configs'] += 1
+    for n in range(max(1, libs//10)):
+        path = os.path.join(root, 'local/bin', 'synth%d'%n)
+        counts['bytes'] += macho_file(path, 'MH_EXECUTE', **options(n))
+        counts['macho'] += 1
+        script = os.path.join(root, 'local/bin', 'synth%d-script'%n)
+        with open(script, 'w') as outfile:
+            outfile.write('#!%s/local/bin/python3\nprint(%d)\n'%(prefix, n))
+        os.chmod(script, 0o755)
+        counts['scripts'] += 1
+    site_packages = os.path.join(root, VENV_LIB, 'site-packages', 'synth')
+    for n in range(max(1, libs//4)):
+        path = os.path.join(site_packages,
+                            '_ext%d.cpython-311-darwin.so'%n)
+        counts['bytes'] += macho_file(path, 'MH_BUNDLE',
+            fat=(fat_every and n % fat_every == 1), **options(n))
+        counts['macho'] += 1
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create a synthetic Sage tree of Mach-O files.')
+    parser.add_argument('directory')
+    parser.add_argument('--libs', type=int, default=200)
+    parser.add_argument('--deps', type=int, default=4,
+                        help='LC_LOAD_DYLIB commands per file')
+    parser.add_argument('--rpaths', type=int, default=2,
+                        help='LC_RPATH commands per file (at most 3)')
+    parser.add_argument('--padding', type=int, default=1024,
+                        help='bytes of header padding')
+    parser.add_argument('--fat-every', type=int, default=3,
+                        help='make every Nth file fat (0 for none)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.directory):
+        print('%s already exists'%args.directory)
+        sys.exit(1)
+    counts = make_tree(args.directory, args.libs, args.deps, args.rpaths,
+                       args.padding, args.fat_every, args.seed)
+    print('Created %(macho)d Mach-O files (%(bytes)d bytes), '
+          '%(symlinks)d symlinks, %(scripts)d scripts and '
+          '%(configs)d config files'%counts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+The backend through which the build scripts run external tools: macher,
+codesign, strip and gzip.
+
+Every call is timed, and its exit status and the number of bytes in the
+files it was given are recorded, so that a whole relocation, signing and
+compression run can be profiled.  The number of concurrent calls of each
+tool can be limited, and any tool can be replaced by a stand-in, so that
+the flow can be run on a system without Apple's tools.
+
+The default backend, TOOLS, is configured by environment variables:
+
+  SAGE_TOOL_<NAME>=<command>    run <command> instead of the tool <name>,
+                                e.g. SAGE_TOOL_CODESIGN=true
+  SAGE_TOOL_LIMIT_<NAME>=<n>    run at most n calls of <name> at once
+  SAGE_TOOL_STANDINS=1          use the stand-ins in STANDINS
+  SAGE_TOOL_LOG=<file>          append a JSON line for every call to file
+
+Limits apply within one process.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Commands which can stand in for tools that only exist on macOS.  They
+# produce the output which the build scripts use but change nothing.
+STANDINS = {
+    'macher': [sys.executable, os.path.join(HERE, 'bench_macho.py')],
+    'codesign': ['true'],
+    'strip': ['true'],
+}
+
+class ToolCall:
+    """
+    The record of one call of an external tool.
+    """
+    def __init__(self, tool, argv, returncode, seconds, size):
+        self.tool = tool
+        self.argv = argv
+        self.returncode = returncode
+        self.seconds = seconds
+        self.bytes = size
+
+    def as_dict(self):
+        return {'tool': self.tool, 'argc': len(self.argv),
+                'returncode': self.returncode,
+                'seconds': round(self.seconds, 6), 'bytes': self.bytes}
+
+def total_size(paths):
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+class Tools:
+    def __init__(self, commands=None, limits=None, log_path=None):
+        self.commands = dict(commands or {})
+        self.limits = {}
+        for name, limit in (limits or {}).items():
+            self.limits[name] = threading.BoundedSemaphore(limit)
+        self.log_path = log_path
+        self.calls = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        commands, limits = {}, {}
+        if environ.get('SAGE_TOOL_STANDINS'):
+            commands.update(STANDINS)
+        for key, value in environ.items():
+            if key.startswith('SAGE_TOOL_LIMIT_'):
+                limits[key[16:].lower()] = int(value)
+            elif key.startswith('SAGE_TOOL_') and key not in (
+                    'SAGE_TOOL_LOG', 'SAGE_TOOL_STANDINS'):
+                commands[key[10:].lower()] = shlex.split(value)
+        return cls(commands, limits, environ.get('SAGE_TOOL_LOG'))
+
+    def command(self, name, default=None):
+        """
+        Return the command which runs the named tool: its stand-in if one
+        is set, else the default command, else the name itself.
+        """
+        return list(self.commands.get(name) or default or [name])
+
+    def run(self, name, args, paths=(), default=None, **kwargs):
+        """
+        Run the named tool with the given arguments, and return the
+        subprocess.CompletedProcess.  The sizes of the files in paths,
+        before the call, are recorded as the bytes touched.  Output is
+        captured unless the keyword arguments say otherwise.
+        """
+        argv = self.command(name, default) + list(args)
+        kwargs.setdefault('capture_output', True)
+        size = total_size(paths)
+        limit = self.limits.get(name)
+        if limit:
+            limit.acquire()
+        try:
+            start = time.perf_counter()
+            result = subprocess.run(argv, **kwargs)
+            elapsed = time.perf_counter() - start
+        finally:
+            if limit:
+                limit.release()
+        call = ToolCall(name, argv, result.returncode, elapsed, size)
+        with self.lock:
+            self.calls.append(call)
+            if self.log_path:
+                with open(self.log_path, 'a') as outfile:
+                    outfile.write(json.dumps(call.as_dict()) + '\n')
+        return result
+
+    def summary(self):
+        """
+        Return a report of the number of calls, failures, time and bytes
+        for each tool used.
+        """
+        totals = {}
+        for call in self.calls:
+            calls, failures, seconds, size = totals.get(call.tool,
+                                                        (0, 0, 0.0, 0))
+            totals[call.tool] = (calls + 1, failures + bool(call.returncode),
+                                 seconds + call.seconds, size + call.bytes)
+        lines = []
+        for name in sorted(totals):
+            calls, failures, seconds, size = totals[name]
+            lines.append('%-10s %6d calls %4d failed %9.2fs %12d bytes'%(
+                name, calls, failures, seconds, size))
+        return '\n'.join(lines)
+
+TOOLS = Tools.from_environment()
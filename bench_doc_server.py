@@ -0,0 +1,106 @@
+"""
+Measure the requests per second which doc_server sustains on a
+compressed documentation site, by default the Sage reference manual
+in the build tree.
+
+A DocServer is started in this process and a number of client threads,
+each with its own keep-alive connection, fetch the pages of the site in
+a random order for a fixed time.  With --revalidate the clients send
+If-None-Match with the ETag of each page, as a browser does when
+revalidating its cache, so every response is a 304.  The clients run in
+the same process as the server, so the figures are a lower bound.
+
+Usage: python3 bench_doc_server.py [--threads N] [--seconds S]
+           [--revalidate] [site]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import http.client
+from doc_server import DocServer
+
+REFERENCE = os.path.join('Sage_framework', 'repo', 'documentation',
+                         'reference')
+
+def site_pages(site):
+    """The URL paths of the compressed pages of a site."""
+    pages = []
+    for dirpath, dirnames, filenames in os.walk(site):
+        for filename in filenames:
+            if filename.endswith('.html.gz'):
+                relpath = os.path.relpath(os.path.join(dirpath, filename[:-3]),
+                                          site)
+                pages.append('/' + relpath.replace(os.path.sep, '/'))
+    return pages
+
+def client(port, pages, deadline, revalidate, totals, lock):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Accept-Encoding': 'gzip'}
+    etags = {}
+    count = size = errors = 0
+    pages = random.sample(pages, len(pages))
+    while time.perf_counter() < deadline:
+        for page in pages:
+            if revalidate and page in etags:
+                headers['If-None-Match'] = etags[page]
+            else:
+                headers.pop('If-None-Match', None)
+            connection.request('GET', page, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            if response.status == 200:
+                etags[page] = response.getheader('ETag')
+            elif response.status != 304:
+                errors += 1
+            count += 1
+            size += len(body)
+            if time.perf_counter() >= deadline:
+                break
+    connection.close()
+    with lock:
+        totals[0] += count
+        totals[1] += size
+        totals[2] += errors
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the documentation server.')
+    parser.add_argument('site', nargs='?', default=REFERENCE)
+    parser.add_argument('--threads', '-t', type=int, default=8,
+                        help='number of client connections')
+    parser.add_argument('--seconds', '-s', type=float, default=10.0)
+    parser.add_argument('--revalidate', action='store_true',
+                        help='send If-None-Match, as a browser revalidating '
+                        'its cache does')
+    args = parser.parse_args()
+    pages = site_pages(args.site)
+    if not pages:
+        print('%s contains no compressed pages'%args.site)
+        sys.exit(1)
+    server = DocServer(args.site)
+    server.start()
+    port = server.server_address[1]
+    totals, lock = [0, 0, 0], threading.Lock()
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    threads = [threading.Thread(target=client, args=(port, pages, deadline,
+                   args.revalidate, totals, lock))
+               for n in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    count, size, errors = totals
+    print('%d pages, %d connections: %d requests in %.1fs, %.0f requests/s, '
+          '%.1f MB/s, %d errors'%(len(pages), args.threads, count, elapsed,
+                                   count/elapsed, size/1e6/elapsed, errors))
+
+if __name__ == '__main__':
+    main()
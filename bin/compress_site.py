@@ -1,26 +1,181 @@
 #!/usr/bin/env python3
 import sys
 import os
+import io
+import gzip
+import stat
+import time
 import shutil
-import subprocess
+import json
+import hashlib
+import argparse
+from docpack import pack_site
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait, FIRST_COMPLETED)
+
+# Smaller duplicates are not worth a symlink.
+DEDUP_MIN_SIZE = 512
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def same_content(path, other):
+    if os.path.islink(path) or os.path.islink(other):
+        return (os.path.islink(path) and os.path.islink(other) and
+                os.readlink(path) == os.readlink(other))
+    return (os.path.getsize(path) == os.path.getsize(other) and
+            file_digest(path) == file_digest(other))
+
+def mergeable(path, target):
+    """
+    Whether path can be moved to target: it is absent or the same.
+    """
+    return not os.path.lexists(target) or same_content(path, target)
+
+def relative_link(link_path, target):
+    """
+    Atomically replace link_path by a relative symlink to target.
+    """
+    temp = link_path + '.link-tmp'
+    os.symlink(os.path.relpath(target, os.path.dirname(link_path)), temp)
+    os.replace(temp, link_path)
+
+# The record of the compressed files, kept in the site root.
+MANIFEST_NAME = '.compress_manifest.json'
+# Maps (content hash, file name) to (path of the .gz file or None, seconds)
+# for the files of the previous site.  Set in each worker process.
+PREVIOUS = {}
+
+def set_previous(previous):
+    global PREVIOUS
+    PREVIOUS = previous
+
+def reuse(old_gz, gz_path):
+    """Hard link the old .gz file into place, or copy it if that fails."""
+    old_gz = os.path.realpath(old_gz)
+    temp = gz_path + '.tmp'
+    try:
+        os.link(old_gz, temp)
+    except OSError:
+        shutil.copy2(old_gz, temp)
+    os.replace(temp, gz_path)
+
+def compress_file(path, level=9, min_ratio=0.0):
+    """
+    Replace a file by a gzip file with a .gz suffix, as gzip does, unless
+    the fraction of the size which compression saves is less than
+    min_ratio.  With min_ratio None the file is always compressed, even
+    if that makes it bigger.  If the previous site had a file with the
+    same name and content, its result is reused instead.  Return (bytes
+    in, bytes out, compressed, content hash, reused, seconds), where
+    seconds is the time which compressing the file took, now or in the
+    previous site.
+    """
+    start = time.perf_counter()
+    st = os.stat(path)
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    digest = hashlib.sha256(data).hexdigest()
+    gz_path = path + '.gz'
+    previous = PREVIOUS.get((digest, os.path.basename(path)))
+    if previous is not None:
+        old_gz, seconds = previous
+        if old_gz is None and min_ratio is not None:
+            return len(data), len(data), False, digest, True, seconds
+        if old_gz is not None and os.path.exists(old_gz):
+            reuse(old_gz, gz_path)
+            os.unlink(path)
+            return (len(data), os.path.getsize(gz_path), True, digest, True,
+                    seconds)
+    buffer = io.BytesIO()
+    # Record the name and mtime in the header, as gzip does.
+    with gzip.GzipFile(os.path.basename(path), 'wb', level, buffer,
+                       st.st_mtime) as outfile:
+        outfile.write(data)
+    compressed = buffer.getvalue()
+    if (min_ratio is not None and
+            len(compressed) > len(data)*(1 - min_ratio)):
+        return (len(data), len(data), False, digest, False,
+                time.perf_counter() - start)
+    temp = gz_path + '.tmp'
+    with open(temp, 'wb') as outfile:
+        outfile.write(compressed)
+    os.chmod(temp, st.st_mode & 0o7777)
+    os.utime(temp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(temp, gz_path)
+    os.unlink(path)
+    return (len(data), len(compressed), True, digest, False,
+            time.perf_counter() - start)
+
+def read_manifest(site):
+    """
+    Return the index of a compressed site's manifest, in the form used
+    for PREVIOUS, or an empty dict if it has none.
+    """
+    try:
+        with open(os.path.join(site, MANIFEST_NAME)) as infile:
+            files = json.load(infile)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+    index = {}
+    for relpath, entry in files.items():
+        gz = os.path.join(site, relpath + '.gz') if entry['gz'] else None
+        index[entry['hash'], os.path.basename(relpath)] = (gz,
+                                                           entry['seconds'])
+    return index
 
 class SiteCompressor:
     """
     Compresses a static web site generated by Sphinx by:
     (1) Merging all _static directories into a single _static directory at the
-        top level.
-    (2) Using gzip to compress the file types below, adding a .gz suffix to
-        the filename. 
+        top level.  Files are moved, not copied, and a _static directory
+        containing a file which differs from the one with the same name in
+        the main _static directory is left alone and reported.
+    (2) Replacing files which are identical to another file anywhere in
+        the site by relative symlinks to a single copy.
+    (3) Using gzip to compress the file types below, adding a .gz suffix to
+        the filename.  This is done in process, by a pool of workers.
+        Text files are always compressed, so that every page can be
+        served as gzip, and other files which compression would shrink
+        by less than min_ratio are left alone.  A manifest of the
+        content hash of each file is saved in the site, and when the
+        previous release's compressed site is given, files which have
+        not changed are linked from it rather than compressed again.
+    The result can also be written to a single pack file, with write_pack.
+    Each of these steps walks the site.  In pipeline mode, run_pipeline
+    makes a single pass over the site instead, merging, cleaning and
+    submitting each entry as the walk reaches it.
     """
     # Filename extensions for files that we want to compress
     gzip_extensions = ['.html', '.css', '.js', '.woff', '.svg']
+    # Those which are compressed whatever the ratio.
+    text_extensions = ['.html', '.css', '.js', '.svg']
     image_extensions = ['.png', '.pdf', '.svg',] 
     
-    def __init__(self, site):
+    def __init__(self, site, jobs=None, min_ratio=0.05, level=9,
+                 previous=None):
         if not os.path.isdir(site):
             raise RuntimeError(
                 'A Brotlifier must be instantiated with a directory')
         self.site = os.path.abspath(site)
+        self.jobs = jobs or os.cpu_count()
+        self.min_ratio = min_ratio
+        self.level = level
+        self.previous = read_manifest(previous) if previous else {}
+        self.manifest = {}
+        # The first output file with each content, in pipeline mode.
+        self.canonical = None
+        self.static_digests = {}
+        self.pending = {}
+        self.pack = None
+        self.stats = dict(files=0, compressed=0, bytes_in=0, bytes_out=0,
+                          seconds=0.0, duplicates=0, dedup_bytes=0,
+                          reused=0, time_saved=0.0)
+        self.conflicts = []
 
     def merge_static_dirs(self):
         static_dirs = []
@@ -32,59 +187,386 @@ class SiteCompressor:
             static_dirs.remove(main_static_dir)
         except ValueError:
             pass
-        # Copy the contents of each subsidiary static dir into the main one
+        # Move the contents of each subsidiary static dir into the main one
         # then replace the subsidiary with a symlink.
         for dirpath in static_dirs:
+            conflicts = self._static_conflicts(dirpath, main_static_dir)
+            if conflicts:
+                self.conflicts += conflicts
+                continue
             # This assumes that all symlinks point inside the static dir.
-            shutil.copytree(dirpath, main_static_dir, symlinks=True,
-                                dirs_exist_ok=True)
+            self._move_tree(dirpath, main_static_dir)
             relpath = os.path.relpath(main_static_dir, os.path.dirname(dirpath))
             shutil.rmtree(dirpath)
             os.symlink(relpath, dirpath)
 
+    @staticmethod
+    def _static_files(dirpath):
+        for subdir, dirnames, filenames in os.walk(dirpath):
+            # Symlinks to directories are moved like files.
+            for name in filenames + [d for d in dirnames
+                    if os.path.islink(os.path.join(subdir, d))]:
+                path = os.path.join(subdir, name)
+                yield path, os.path.relpath(path, dirpath)
+
+    def _static_conflicts(self, dirpath, main_static_dir, same=mergeable):
+        conflicts = []
+        for path, relpath in self._static_files(dirpath):
+            target = os.path.join(main_static_dir, relpath)
+            if not same(path, target):
+                conflicts.append((path, target))
+        return conflicts
+
+    def _same_as_processed(self, path, target):
+        """
+        Whether a file can be merged with a file of the main _static
+        directory which the pipeline may have compressed or replaced by
+        a symlink, judged by the content hash recorded for it.
+        """
+        digest = self.static_digests.get(os.path.relpath(target, self.site))
+        if digest is None or os.path.islink(path):
+            return mergeable(path, target)
+        return file_digest(path) == digest
+
+    def _processed(self, target):
+        """
+        Whether the pipeline has seen a file of the main _static directory.
+        """
+        return (os.path.lexists(target) or
+                os.path.relpath(target, self.site) in self.static_digests)
+
+    def _move_tree(self, dirpath, main_static_dir, exists=os.path.lexists):
+        moved = []
+        for path, relpath in self._static_files(dirpath):
+            target = os.path.join(main_static_dir, relpath)
+            if not exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+                moved.append(target)
+        return moved
+
     def clean_images(self):
         """All images should be in _static or _images."""
         # I have no idea why these get copied rather than moved.
         # Apparently this does not happen with a standard build.
         to_delete = []
         for dirpath, dirnames, filenames in os.walk(self.site):
-            if dirpath.find('_static') >= 0 or dirpath.find('_images') >= 0:
-                continue
             for filename in filenames:
-                base, ext = os.path.splitext(filename)
-                if ext in self.image_extensions:
-                    print('deleting', os.path.join(dirpath, filename))
-                    to_delete.append(os.path.join(dirpath, filename))
+                path = os.path.join(dirpath, filename)
+                if self._extraneous_image(path):
+                    print('deleting', path)
+                    to_delete.append(path)
         for path in to_delete:
             os.unlink(path)
 
-    def compress_files(self):
-        """Compress compressible files."""
-        compressible = []
+    def _extraneous_image(self, path):
+        dirpath, filename = os.path.split(path)
+        if dirpath.find('_static') >= 0 or dirpath.find('_images') >= 0:
+            return False
+        return os.path.splitext(filename)[1] in self.image_extensions
+
+    @staticmethod
+    def _canonical_key(path):
+        # Prefer copies in the shared directories, then shallow paths.
+        shared = '_static' in path or '_images' in path
+        return (not shared, path.count(os.path.sep), path)
+
+    def dedup_files(self):
+        """
+        Replace each set of identical files by relative symlinks to one
+        canonical copy.  Files are grouped by size and only files whose
+        size is shared are hashed, by a pool of threads.
+        """
+        by_size = {}
+        for dirpath, dirnames, filenames in os.walk(self.site):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_size >= DEDUP_MIN_SIZE:
+                    by_size.setdefault(st.st_size, []).append(path)
+        candidates = [path for paths in by_size.values() if len(paths) > 1
+                      for path in paths]
+        with ThreadPoolExecutor(self.jobs) as pool:
+            digests = list(pool.map(file_digest, candidates))
+        groups = {}
+        for path, digest in zip(candidates, digests):
+            groups.setdefault(digest, []).append(path)
+        for paths in groups.values():
+            if len(paths) < 2:
+                continue
+            paths.sort(key=self._canonical_key)
+            for path in paths[1:]:
+                size = os.path.getsize(path)
+                relative_link(path, paths[0])
+                self.stats['duplicates'] += 1
+                self.stats['dedup_bytes'] += size
+
+    def compressible_files(self):
         for dirpath, dirnames, filenames in os.walk(self.site):
             for filename in filenames:
                 base, ext = os.path.splitext(filename)
                 if ext in self.gzip_extensions:
-                    compressible.append(os.path.join(dirpath, filename))
-        for path in compressible:
-            subprocess.run(['gzip', '--best', path])
+                    path = os.path.join(dirpath, filename)
+                    if not os.path.islink(path):
+                        yield path
+
+    def _min_ratio(self, path):
+        if os.path.splitext(path)[1] in self.text_extensions:
+            return None
+        return self.min_ratio
+
+    def compress_files(self):
+        """
+        Compress compressible files.  The walk is consumed as the workers
+        go, with a bounded number of files in flight.
+        """
+        start = time.perf_counter()
+        with self._pool() as pool:
+            pending = {}
+            for path in self.compressible_files():
+                self._submit(pool, pending, self._compressed, path,
+                             compress_file, path, self.level,
+                             self._min_ratio(path))
+            self._collect(pending, list(pending))
+        self.stats['seconds'] += time.perf_counter() - start
+        self._relink_compressed()
+        self._save_manifest()
+
+    def run_pipeline(self):
+        """
+        Merge the _static directories, delete extraneous images, remove
+        duplicates and compress files in a single walk of the site.  The
+        top level _static and _images directories are walked first, so
+        that files moved into the main _static directory are visited as
+        they are moved, and so that the copies there tend to be kept.
+        Duplicates are found from the content hashes computed by the
+        workers, so a set of identical files is compressed more than
+        once; once all are done, each set is replaced by links to the
+        copy dedup_files would keep, whatever order they finished in.
+        Work in flight is collected before each subsidiary _static
+        directory is merged, since it is compared with the results.  At
+        most 4*jobs files are in flight, but the manifest, the outputs
+        grouped by content and the symlinks to be relinked hold an entry
+        for each file of the site, so memory grows with its size.
+        """
+        start = time.perf_counter()
+        self.canonical = {}
+        self.static_digests = {}
+        links = []
+        with self._pool() as pool:
+            self.pending = pending = {}
+            for path, st in self._scan(self.site):
+                if stat.S_ISLNK(st.st_mode):
+                    links.append(path)
+                elif not stat.S_ISREG(st.st_mode):
+                    continue
+                elif self._extraneous_image(path):
+                    print('deleting', path)
+                    os.unlink(path)
+                elif os.path.splitext(path)[1] in self.gzip_extensions:
+                    self._submit(pool, pending, self._compressed, path,
+                                 compress_file, path, self.level,
+                                 self._min_ratio(path))
+                elif st.st_size >= DEDUP_MIN_SIZE:
+                    self._submit(pool, pending, self._hashed, path,
+                                 file_digest, path)
+            self._collect(pending, list(pending))
+        self._link_duplicates()
+        self._relink_compressed(links)
+        self._save_manifest()
+        self.stats['seconds'] += time.perf_counter() - start
+
+    def _scan(self, dirpath):
+        """
+        Yield (path, lstat result) for each file and symlink below
+        dirpath, merging subsidiary _static directories on the way.
+        """
+        main_static_dir = os.path.join(self.site, '_static')
+        with os.scandir(dirpath) as entries:
+            entries = sorted(entries, key=lambda entry: (
+                entry.name not in ('_static', '_images'), entry.name))
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False)
+                continue
+            if entry.name == '_static' and entry.path != main_static_dir:
+                # Let the work on the main _static directory settle.
+                self._collect(self.pending, list(self.pending))
+                conflicts = self._static_conflicts(entry.path,
+                    main_static_dir, self._same_as_processed)
+                if not conflicts:
+                    moved = self._move_tree(entry.path, main_static_dir,
+                                            self._processed)
+                    shutil.rmtree(entry.path)
+                    os.symlink(os.path.relpath(main_static_dir, dirpath),
+                               entry.path)
+                    for path in moved:
+                        yield path, os.lstat(path)
+                    continue
+                self.conflicts += conflicts
+            yield from self._scan(entry.path)
+
+    def _pool(self):
+        return ProcessPoolExecutor(self.jobs, initializer=set_previous,
+                                   initargs=(self.previous,))
+
+    def _submit(self, pool, pending, handler, path, function, *args):
+        """
+        Submit a task, after waiting for some to finish if 4*jobs are
+        already in flight.  The handler is called with the path and the
+        result when the task is collected.
+        """
+        if len(pending) >= 4*self.jobs:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            self._collect(pending, done)
+        pending[pool.submit(function, *args)] = (path, handler)
+
+    def _relink_compressed(self, links=None):
+        """
+        Point the symlinks to files which were compressed at the .gz files.
+        If the list of symlinks is not given, the site is walked for them.
+        """
+        if links is None:
+            links = [os.path.join(dirpath, filename)
+                     for dirpath, dirnames, filenames in os.walk(self.site)
+                     for filename in filenames]
+        for path in links:
+            if not os.path.islink(path) or os.path.exists(path):
+                continue
+            dirpath = os.path.dirname(path)
+            target = os.readlink(path)
+            if os.path.exists(os.path.join(dirpath, target + '.gz')):
+                os.symlink(target + '.gz', path + '.gz')
+                os.unlink(path)
+
+    def _save_manifest(self):
+        with open(os.path.join(self.site, MANIFEST_NAME), 'w') as outfile:
+            json.dump({'files': self.manifest}, outfile)
+
+    def _collect(self, pending, futures):
+        for future in futures:
+            path, handler = pending.pop(future)
+            handler(path, future.result())
+
+    def _hashed(self, path, digest):
+        self._record_static(path, digest)
+        self._dedup(path, digest, False)
+
+    def _record_static(self, path, digest):
+        relpath = os.path.relpath(path, self.site)
+        if relpath.startswith('_static' + os.path.sep):
+            self.static_digests[relpath] = digest
+
+    def _dedup(self, output, digest, compressed):
+        """
+        Record an output file of the pipeline with the others having the
+        same content.
+        """
+        self.canonical.setdefault((digest, compressed), []).append(output)
+
+    def _link_duplicates(self):
+        """
+        Replace each set of identical output files by relative symlinks
+        to one canonical copy, chosen as in dedup_files.
+        """
+        for paths in self.canonical.values():
+            if len(paths) < 2:
+                continue
+            paths.sort(key=self._canonical_key)
+            for path in paths[1:]:
+                self.stats['duplicates'] += 1
+                self.stats['dedup_bytes'] += os.path.getsize(path)
+                relative_link(path, paths[0])
+
+    def _compressed(self, path, result):
+        bytes_in, bytes_out, compressed, digest, reused, seconds = result
+        self.stats['files'] += 1
+        self.stats['compressed'] += compressed
+        self.stats['bytes_in'] += bytes_in
+        self.stats['bytes_out'] += bytes_out
+        if reused:
+            self.stats['reused'] += 1
+            self.stats['time_saved'] += seconds
+        self.manifest[os.path.relpath(path, self.site)] = {
+            'hash': digest, 'gz': compressed, 'seconds': seconds}
+        if self.canonical is None:
+            return
+        self._record_static(path, digest)
+        if bytes_in >= DEDUP_MIN_SIZE:
+            self._dedup(path + '.gz' if compressed else path, digest,
+                        compressed)
+
+    def write_pack(self, path):
+        """
+        Write the compressed site to a single pack file (see docpack).
+        """
+        start = time.perf_counter()
+        count, size = pack_site(self.site, path, exclude=(MANIFEST_NAME,))
+        self.pack = (path, count, size, time.perf_counter() - start)
+
+    def report(self):
+        s = self.stats
+        lines = ['%s differs from %s; not merged'%conflict
+                 for conflict in self.conflicts]
+        lines.append('Replaced %d duplicate files by symlinks, saving '
+                     '%.1f MB'%(s['duplicates'], s['dedup_bytes']/1e6))
+        lines.append('Compressed %d of %d files, %.1f MB -> %.1f MB in '
+                     '%.1fs (%.1f MB/s)'%(s['compressed'], s['files'],
+                     s['bytes_in']/1e6, s['bytes_out']/1e6, s['seconds'],
+                     s['bytes_in']/1e6/max(s['seconds'], 1e-9)))
+        if self.previous:
+            lines.append('Reused %d of %d files from the previous site '
+                         '(%.0f%% hit rate), saving %.1fs of compression'%(
+                         s['reused'], s['files'],
+                         100*s['reused']/max(s['files'], 1), s['time_saved']))
+        if self.pack:
+            lines.append('Packed %d entries (%.1f MB) into %s in %.1fs'%(
+                self.pack[1], self.pack[2]/1e6, self.pack[0], self.pack[3]))
+        return '\n'.join(lines)
 
 if __name__ == '__main__':
-    try:
-        site = sys.argv[1]
-    except IndexError:
-        print('Please provide the site root directory as an argument.')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description='Merge the _static directories of a Sphinx site and '
+        'compress its pages.')
+    parser.add_argument('site', help='the site root directory')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of compression processes')
+    parser.add_argument('--min-ratio', type=float, default=0.05,
+                        help='leave files other than text files which '
+                        'compression shrinks by less than this fraction '
+                        'uncompressed (default: %(default)s)')
+    parser.add_argument('--previous', metavar='SITE',
+                        help='a site compressed earlier, whose unchanged '
+                        'files can be reused')
+    parser.add_argument('--pack', metavar='FILE',
+                        help='also write the compressed site to a single '
+                        'indexed pack file')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='do all of the work in a single walk of the '
+                        'site')
+    args = parser.parse_args()
+    site = args.site
     if not os.path.isdir(site):
         print('The site root must be a directory.')
         sys.exit(1)
-    compressor = SiteCompressor(site)
-    print('Merging _static directories ..')
-    compressor.merge_static_dirs()
-    print("Deleting extraneous images ...")
-    compressor.clean_images()
-    print('Compressing files ...')
-    compressor.compress_files()
+    compressor = SiteCompressor(site, args.jobs, args.min_ratio,
+                                previous=args.previous)
+    if args.pipeline:
+        print('Merging, cleaning, deduplicating and compressing ...')
+        compressor.run_pipeline()
+    else:
+        print('Merging _static directories ..')
+        compressor.merge_static_dirs()
+        print("Deleting extraneous images ...")
+        compressor.clean_images()
+        print('Removing duplicate files ...')
+        compressor.dedup_files()
+        print('Compressing files ...')
+        compressor.compress_files()
+    if args.pack:
+        print('Writing %s ...'%args.pack)
+        compressor.write_pack(args.pack)
+    print(compressor.report())
 
                 
             
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+A single file archive of a compressed documentation site, to be shipped
+instead of tens of thousands of small files.
+
+The pack starts with MAGIC, followed by the data of each entry and then
+an index of the entries sorted by path, and ends with a trailer giving
+the offset of the index and the number of entries.  Each entry is either
+a gzip member, which can be sent as is with Content-Encoding: gzip, or
+stored, for files which do not compress.  Files which are the same file
+in the site, through symlinks or hard links, share their data.
+
+DocPack reads a pack through mmap.  The index is read once, so each
+page is one seek away, and the stored bytes of an entry are available
+without copying.
+
+Usage: python3 docpack.py <pack> [path ...]
+lists the entries of a pack, or writes the given entries to stdout.
+"""
+
+import os
+import sys
+import gzip
+import mmap
+import struct
+import bisect
+from collections import namedtuple
+
+MAGIC = b'SAGEDOC1'
+GZIP_MAGIC = b'\x1f\x8b'
+# Entry flags.
+GZIPPED = 1
+# offset, stored size, size, mtime, flags, length of the name.
+INDEX_RECORD = struct.Struct('<QQQdBH')
+# index offset, number of entries, magic.
+TRAILER = struct.Struct('<QI8s')
+
+Entry = namedtuple('Entry', ['offset', 'stored', 'size', 'mtime', 'gzipped'])
+
+class DocPackError(RuntimeError):
+    pass
+
+def gzip_size(data):
+    """The uncompressed size recorded at the end of a gzip member."""
+    return struct.unpack('<I', data[-4:])[0]
+
+class PackWriter:
+    def __init__(self, path):
+        self.path = path
+        self.temp = path + '.tmp'
+        self.outfile = open(self.temp, 'wb')
+        self.outfile.write(MAGIC)
+        self.index = {}
+        # Maps (st_dev, st_ino) to the entry for a file already written.
+        self.written = {}
+
+    def add(self, name, data, mtime, gzipped=False, size=None):
+        offset = self.outfile.tell()
+        self.outfile.write(data)
+        if size is None:
+            size = gzip_size(data) if gzipped else len(data)
+        entry = Entry(offset, len(data), size, mtime, gzipped)
+        self.index[name] = entry
+        return entry
+
+    def add_file(self, name, path):
+        """
+        Add a file of a compressed site.  A file with a .gz suffix which
+        is a gzip file is added without the suffix, as a gzip entry.
+        """
+        st = os.stat(path)
+        gzipped = False
+        if name.endswith('.gz'):
+            with open(path, 'rb') as infile:
+                gzipped = infile.read(2) == GZIP_MAGIC
+            if gzipped:
+                name = name[:-3]
+        entry = self.written.get((st.st_dev, st.st_ino))
+        if entry is not None:
+            self.index[name] = entry
+            return entry
+        with open(path, 'rb') as infile:
+            data = infile.read()
+        entry = self.add(name, data, st.st_mtime, gzipped)
+        self.written[st.st_dev, st.st_ino] = entry
+        return entry
+
+    def close(self):
+        """Write the index and the trailer, and move the pack into place."""
+        index_offset = self.outfile.tell()
+        names = sorted(self.index, key=os.fsencode)
+        for name in names:
+            encoded = os.fsencode(name)
+            self.outfile.write(INDEX_RECORD.pack(*self.index[name],
+                                                 len(encoded)))
+            self.outfile.write(encoded)
+        self.outfile.write(TRAILER.pack(index_offset, len(names), MAGIC))
+        self.outfile.close()
+        os.replace(self.temp, self.path)
+
+def pack_site(site, path, exclude=()):
+    """
+    Write every file below site, following symlinks, to a pack.  Paths
+    in the pack are relative to site and use / as the separator.  Return
+    the number of entries and the number of bytes of data.
+    """
+    writer = PackWriter(path)
+    try:
+        for dirpath, dirnames, filenames in os.walk(site, followlinks=True):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename in exclude:
+                    continue
+                fullpath = os.path.join(dirpath, filename)
+                if not os.path.isfile(fullpath):
+                    continue
+                relpath = os.path.relpath(fullpath, site)
+                writer.add_file(relpath.replace(os.path.sep, '/'), fullpath)
+    except BaseException:
+        writer.outfile.close()
+        os.unlink(writer.temp)
+        raise
+    size = writer.outfile.tell() - len(MAGIC)
+    writer.close()
+    return len(writer.index), size
+
+class DocPack:
+    """
+    Random access to the entries of a pack, by path.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise DocPackError('%s is empty'%path)
+        try:
+            self._read_index()
+        except (DocPackError, struct.error):
+            self.close()
+            raise DocPackError('%s is not a documentation pack'%path)
+
+    def _read_index(self):
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise DocPackError
+        index_offset, count, magic = TRAILER.unpack_from(
+            self.data, len(self.data) - TRAILER.size)
+        if magic != MAGIC:
+            raise DocPackError
+        self.names, self.entries = [], []
+        position = index_offset
+        for n in range(count):
+            *fields, length = INDEX_RECORD.unpack_from(self.data, position)
+            position += INDEX_RECORD.size
+            self.names.append(bytes(self.data[position:position + length]))
+            position += length
+            fields[-1] = bool(fields[-1] & GZIPPED)
+            self.entries.append(Entry(*fields))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (os.fsdecode(name) for name in self.names)
+
+    def __contains__(self, name):
+        return self.entry(name) is not None
+
+    def entry(self, name):
+        """Return the Entry for a path, or None if there is none."""
+        name = os.fsencode(name)
+        n = bisect.bisect_left(self.names, name)
+        if n < len(self.names) and self.names[n] == name:
+            return self.entries[n]
+        return None
+
+    def raw(self, name):
+        """
+        Return a memoryview of the stored bytes of an entry: a gzip member
+        if the entry is gzipped.  The view must be released before the
+        pack is closed.
+        """
+        entry = self.entry(name)
+        if entry is None:
+            raise KeyError(name)
+        return memoryview(self.data)[entry.offset:entry.offset + entry.stored]
+
+    def read(self, name):
+        """Return the uncompressed contents of an entry."""
+        entry = self.entry(name)
+        with self.raw(name) as data:
+            return gzip.decompress(data) if entry.gzipped else bytes(data)
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    with DocPack(sys.argv[1]) as pack:
+        if len(sys.argv) == 2:
+            for name in pack:
+                entry = pack.entry(name)
+                print('%10d %10d %s %s'%(entry.size, entry.stored,
+                    'gz' if entry.gzipped else '  ', name))
+            return
+        for name in sys.argv[2:]:
+            sys.stdout.buffer.write(pack.read(name))
+
+if __name__ == '__main__':
+    main()
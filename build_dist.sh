@@ -28,7 +28,7 @@ ln -s $PYTHON3 $APP/Contents/MacOS/Python
 cp jinja/output/Info.plist $APP/Contents
 cp icon/{Sage.icns,sage_icon_1024.png} $APP/Contents/Resources
 cp logos/{sage_logo_512.png,sage_logo_256.png} $APP/Contents/Resources
-cp main.py $APP/Contents/Resources
+cp main.py doc_server.py $APP/Contents/Resources
 # Build Tcl and Tk frameworks
 cd TclTk_frameworks
 make
@@ -42,5 +42,6 @@ mv TclTk_frameworks/Frameworks/{Tcl,Tk}.framework $APP/Contents/Frameworks
 mv Sage_framework/build/Sage.framework $APP/Contents/Frameworks
 # Add the documentation
 cp -R Sage_framework/repo/documentation $APP/Contents/Resources
+rm -f $APP/Contents/Resources/documentation/.compress_manifest.json
 # Sign the app
 bin/sign_app
@@ -0,0 +1,345 @@
+"""
+A local web server for the compressed documentation site written by
+bin/compress_site.py.
+
+A request for /foo.html is answered with foo.html.gz, if it exists, sent
+as is with Content-Encoding: gzip, so the server never decompresses a
+page.  The body is sent with sendfile, from a small LRU cache of open
+files, so it is not copied through Python either.  Responses carry an
+ETag, so a browser revalidating its cache gets a 304, and single byte
+ranges are supported.  The rare client which does not accept gzip gets
+the page decompressed.  Requests are handled by a thread each.
+
+The documentation in the app bundle does not change while the app runs,
+so open files are not checked for changes.
+
+Usage: python3 doc_server.py [--port N] <site>
+"""
+
+import os
+import re
+import sys
+import gzip
+import argparse
+import mimetypes
+import threading
+import posixpath
+from collections import OrderedDict
+from urllib.parse import urlsplit, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SEND_CHUNK = 1 << 20
+RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+class OpenFile:
+    """
+    An open file of the site, with the result of fstat.  It is closed
+    when it has been evicted from the cache and is no longer in use.
+    """
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.stat = os.fstat(self.fd)
+        self.users = 0
+        self.evicted = False
+
+    @property
+    def etag(self):
+        return '"%x-%x"'%(self.stat.st_mtime_ns, self.stat.st_size)
+
+class FileCache:
+    """
+    An LRU cache of OpenFiles, shared by the request threads.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        with self.lock:
+            open_file = self.files.get(path)
+            if open_file is not None:
+                self.files.move_to_end(path)
+                open_file.users += 1
+                return open_file
+        open_file = OpenFile(path)
+        with self.lock:
+            if path in self.files:
+                os.close(open_file.fd)
+                open_file = self.files[path]
+                self.files.move_to_end(path)
+            else:
+                self.files[path] = open_file
+                while len(self.files) > self.size:
+                    old_path, old = self.files.popitem(last=False)
+                    old.evicted = True
+                    if not old.users:
+                        os.close(old.fd)
+            open_file.users += 1
+            return open_file
+
+    def release(self, open_file):
+        with self.lock:
+            open_file.users -= 1
+            if open_file.evicted and not open_file.users:
+                os.close(open_file.fd)
+
+    def close(self):
+        with self.lock:
+            for open_file in self.files.values():
+                open_file.evicted = True
+                if not open_file.users:
+                    os.close(open_file.fd)
+            self.files.clear()
+
+def accepts_gzip(header):
+    """
+    Whether an Accept-Encoding header allows gzip, taking q-values into
+    account: gzip;q=0 refuses it, and * covers it if gzip is not named.
+    """
+    qualities = {}
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+def send_range(sock, fd, offset, count):
+    """
+    Send count bytes of a file, starting at offset, to a socket.
+    """
+    out = sock.fileno()
+    while count > 0:
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(out, fd, offset, min(count, SEND_CHUNK))
+        else:
+            sent = sock.send(os.pread(fd, min(count, SEND_CHUNK), offset))
+        if not sent:
+            break
+        offset += sent
+        count -= sent
+
+class DocRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'SageDocs'
+    # The headers and the body are sent separately, so without this each
+    # response waits for a delayed acknowledgement.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def local_path(self, url_path):
+        """
+        The path below the root for a URL path, or None if it is outside.
+        """
+        parts = [part for part in posixpath.normpath(url_path).split('/')
+                 if part]
+        if any(part in ('.', '..') for part in parts):
+            return None
+        return os.path.join(self.server.root, *parts)
+
+    def find(self):
+        """
+        Return (path of the file to send, its URL path, gzipped) for the
+        request, or None if there is no such page.
+        """
+        url_path = unquote(urlsplit(self.path).path)
+        if url_path.endswith('/'):
+            url_path += 'index.html'
+        url_path = posixpath.normpath(url_path)
+        path = self.local_path(url_path)
+        if path is None:
+            return None
+        if os.path.isfile(path + '.gz'):
+            return path + '.gz', url_path, True
+        if os.path.isfile(path):
+            return path, url_path, False
+        return None
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        found = self.find()
+        if found is None:
+            if not self.redirect_directory():
+                self.send_error(404)
+            return
+        path, url_path, gzipped = found
+        try:
+            open_file = self.server.cache.acquire(path)
+        except OSError:
+            self.send_error(404)
+            return
+        try:
+            self.send_file(open_file, url_path, gzipped, head)
+        finally:
+            self.server.cache.release(open_file)
+
+    def redirect_directory(self):
+        """
+        Redirect a request for a directory without a trailing slash to
+        the directory, as relative links in its index page require.
+        Return True if a redirect was sent.
+        """
+        url = urlsplit(self.path)
+        url_path = unquote(url.path)
+        if url_path.endswith('/'):
+            return False
+        path = self.local_path(url_path)
+        if path is None or not os.path.isdir(path):
+            return False
+        location = url.path + '/'
+        if url.query:
+            location += '?' + url.query
+        self.send_response(301)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return True
+
+    def send_file(self, open_file, url_path, gzipped, head):
+        content_type, encoding = mimetypes.guess_type(url_path)
+        if encoding is not None:
+            # A compressed file asked for by its own name is sent as it
+            # is, so it must not look like a page.
+            content_type = ('application/gzip' if encoding == 'gzip'
+                            else 'application/octet-stream')
+        etag = open_file.etag
+        identity = (gzipped and
+                    not accepts_gzip(self.headers.get('Accept-Encoding', '')))
+        if identity:
+            etag = etag[:-1] + '-identity"'
+        if self.headers.get('If-None-Match') in (etag, '*'):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if identity:
+            self.send_decompressed(open_file, content_type, etag, head)
+            return
+        size = open_file.stat.st_size
+        start, end = 0, size
+        requested = self.byte_range(size, etag)
+        if requested is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d'%size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if requested:
+            start, end = requested
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d'%(
+                start, end - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type',
+                         content_type or 'application/octet-stream')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if not head:
+            send_range(self.connection, open_file.fd, start, end - start)
+
+    def byte_range(self, size, etag):
+        """
+        Return (start, end) for a satisfiable single range, False for an
+        unsatisfiable one, or None to send the whole file.
+        """
+        header = self.headers.get('Range')
+        if not header:
+            return None
+        if self.headers.get('If-Range') not in (None, etag):
+            return None
+        match = RANGE.match(header.strip())
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        first, last = match.groups()
+        if first == '':
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = min(size, int(last) + 1) if last else size
+        if start >= end:
+            return False
+        return start, end
+
+    def send_decompressed(self, open_file, content_type, etag, head):
+        # The descriptor is shared, so its position must not be used.
+        data = gzip.decompress(os.pread(open_file.fd, open_file.stat.st_size,
+                                        0))
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         content_type or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+class DocServer(ThreadingHTTPServer):
+    """
+    Serves the site below root on localhost.  With port 0 a free port is
+    chosen; the url attribute gives the address of the site.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, port=0, cache_size=256, verbose=False):
+        self.root = os.path.abspath(root)
+        self.cache = FileCache(cache_size)
+        self.verbose = verbose
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port),
+                                     DocRequestHandler)
+        self.url = 'http://127.0.0.1:%d/'%self.server_address[1]
+
+    def start(self):
+        """Serve in a daemon thread, and return the thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.cache.close()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a compressed documentation site on localhost.')
+    parser.add_argument('site')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not log requests')
+    args = parser.parse_args()
+    if not os.path.isdir(args.site):
+        print('%s is not a directory'%args.site)
+        sys.exit(1)
+    server = DocServer(args.site, args.port, verbose=not args.quiet)
+    print('Serving %s at %s'%(args.site, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
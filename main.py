@@ -15,6 +15,7 @@ from tkinter.filedialog import askdirectory
 from tkinter.messagebox import showerror, showwarning, askyesno, askokcancel
 from tkinter.scrolledtext import ScrolledText
 from sage.version import version as sage_version
+from doc_server import DocServer
 import os
 import plistlib
 import platform
@@ -594,12 +595,29 @@ The app is copyright © 2021 by Marc Culler, Nathan Dunfield, Matthias Gӧrner a
         apple_menu = tkinter.Menu(menubar, name="apple")
         apple_menu.add_command(label='About SageMath ...', command=self.about_sagemath)
         menubar.add_cascade(menu=apple_menu)
+        help_menu = tkinter.Menu(menubar, name="help")
+        help_menu.add_command(label='SageMath Documentation',
+                              command=self.show_documentation)
+        menubar.add_cascade(menu=help_menu, label='Help')
+        self.doc_server = None
         root.config(menu=menubar)
         ttk.Label(root, text="SageMath 9.4").pack(padx=20, pady=20)
 
     def about_sagemath(self):
         AboutDialog(self.root_window, 'SageMath', self.about)
 
+    def show_documentation(self):
+        if self.doc_server is None:
+            site = path_join(self.resource_dir, 'documentation')
+            try:
+                self.doc_server = DocServer(site)
+            except OSError as e:
+                showerror(parent=self.root_window,
+                          message='Cannot serve the documentation: %s'%e)
+                return
+            self.doc_server.start()
+        subprocess.run(['open', self.doc_server.url], capture_output=True)
+
     def edit_env(self):
         editor = EnvironmentEditor(self.launcher)
         editor.go()